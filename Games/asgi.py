@@ -9,7 +9,10 @@ asgi_application = get_asgi_application()
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 
+from Nations.engines import start_engine_warmup
+
 from . import routing
+from .drain import install_drain_handler
 
 application = ProtocolTypeRouter(
     {
@@ -17,3 +20,6 @@ application = ProtocolTypeRouter(
         'websocket': AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns)),
     }
 )
+
+install_drain_handler()
+start_engine_warmup()
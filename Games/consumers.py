@@ -8,11 +8,14 @@ from django.utils.timezone import make_aware
 
 from users.models import User, get_deleted_user
 from Nations.models import Match, MatchPlayer
+from .metrics import InstrumentedConsumerMixin
 
 import json
 import datetime
 
-class GamesConsumer(AsyncJsonWebsocketConsumer):
+class GamesConsumer(InstrumentedConsumerMixin, AsyncJsonWebsocketConsumer):
+    metrics_name = 'games'
+
     async def connect(self):
         user = self.scope['user']
         self.user_group_name = None
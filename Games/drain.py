@@ -0,0 +1,54 @@
+from django.conf import settings
+
+from .metrics import Counter, Gauge
+
+import asyncio
+import logging
+import random
+import signal
+import weakref
+
+logger = logging.getLogger(__name__)
+
+draining_gauge = Gauge('tabony_draining', 'Whether this worker is draining its websockets.')
+drained_sockets = Counter('tabony_drained_sockets_total', 'Websockets told to reconnect elsewhere while draining.')
+refused_sockets = Counter('tabony_refused_sockets_total', 'Websocket connections refused while draining.')
+
+draining = False
+open_consumers = weakref.WeakKeyDictionary()
+
+def register_consumer(consumer):
+    open_consumers.setdefault(asyncio.get_running_loop(), weakref.WeakSet()).add(consumer)
+
+def unregister_consumer(consumer):
+    consumers = open_consumers.get(asyncio.get_running_loop())
+    if consumers is not None:
+        consumers.discard(consumer)
+
+def reconnect_delay():
+    return random.randint(settings.DRAIN_RECONNECT_MIN_DELAY, settings.DRAIN_RECONNECT_MAX_DELAY)
+
+async def drain_consumers(loop):
+    consumers = list(open_consumers.get(loop, ()))
+    logger.warning('Draining %d websockets', len(consumers))
+    results = await asyncio.gather(*(consumer.drain(reconnect_delay()) for consumer in consumers), return_exceptions=True)
+    for (consumer, result) in zip(consumers, results):
+        if isinstance(result, Exception):
+            logger.error('Could not drain %r', consumer, exc_info=result)
+        else:
+            drained_sockets.inc(consumer=consumer.metrics_name)
+    logger.warning('Drained %d websockets', len(consumers))
+
+def start_drain(signum=None, frame=None):
+    global draining
+    if draining:
+        return
+    draining = True
+    draining_gauge.set(1)
+    for loop in list(open_consumers):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(loop.create_task, drain_consumers(loop))
+
+def install_drain_handler():
+    if settings.DRAIN_SIGNAL:
+        signal.signal(getattr(signal, settings.DRAIN_SIGNAL), start_drain)
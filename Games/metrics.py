@@ -0,0 +1,306 @@
+from channels.exceptions import StopConsumer
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+import bisect
+import collections
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+registry = []
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for (key, value) in labels) + '}'
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = sorted(self.values.items())
+        for (labels, value) in values:
+            lines += self.render_value(labels, value)
+        return lines
+
+    def render_value(self, labels, value):
+        return [f'{self.name}{format_labels(labels)} {value}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            observations = self.values[key]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                observations[0][index] += 1
+            observations[1] += 1
+            observations[2] += value
+
+    def render_value(self, labels, value):
+        (bucket_counts, count, total) = value
+        lines = []
+        cumulative = 0
+        for (bound, bucket_count) in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+        lines.append(f'{self.name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+        lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+        lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+        return lines
+
+class Summary(Metric):
+    kind = 'summary'
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, name, description, window=1024):
+        super().__init__(name, description)
+        self.window = window
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [collections.deque(maxlen=self.window), 0, 0]
+            observations = self.values[key]
+            observations[0].append(value)
+            observations[1] += 1
+            observations[2] += value
+
+    def render_value(self, labels, value):
+        (recent, count, total) = value
+        recent = sorted(recent)
+        lines = []
+        for quantile in self.quantiles:
+            lines.append(f'{self.name}{format_labels(labels + (("quantile", quantile),))} {recent[min(len(recent) - 1, int(quantile * len(recent)))]}')
+        lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+        lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+        return lines
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+query_buckets = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+open_sockets = Gauge('tabony_open_sockets', 'Open websockets per consumer.')
+engine_threads = Gauge('tabony_engine_threads', 'Live Nations engine threads.')
+state_queue_wait_seconds = Histogram('tabony_state_queue_wait_seconds', 'Time spent waiting for the engine thread to report a state.', latency_buckets)
+handler_seconds = Histogram('tabony_handler_seconds', 'Consumer handler latency per message type.', latency_buckets)
+handler_queries = Histogram('tabony_handler_queries', 'Database queries per consumer message.', query_buckets)
+handler_query_seconds = Histogram('tabony_handler_query_seconds', 'Database time per consumer message.', latency_buckets)
+view_seconds = Histogram('tabony_view_seconds', 'HTTP view latency.', latency_buckets)
+view_queries = Histogram('tabony_view_queries', 'Database queries per HTTP request.', query_buckets)
+loop_lag_seconds = Summary('tabony_loop_lag_seconds', 'Event loop heartbeat lag over the most recent heartbeats.')
+loop_stalls = Counter('tabony_loop_stalls_total', 'Event loop stalls longer than the stall threshold.')
+group_sends = Counter('tabony_group_sends_total', 'Channel layer group_send calls per consumer and event type.')
+emails = Counter('tabony_emails_total', 'Emails by kind and outcome.')
+
+class QueryTally:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+current_query_tally = contextvars.ContextVar('current_query_tally', default=None)
+
+def count_queries(execute, sql, params, many, context):
+    query_tally = current_query_tally.get()
+    if query_tally is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        query_tally.count += 1
+        query_tally.duration += time.perf_counter() - start
+
+def install_query_counter(sender, connection, **kwargs):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+connection_created.connect(install_query_counter)
+for connection in connections.all(initialized_only=True):
+    install_query_counter(None, connection)
+
+handler_observers = []
+
+@contextlib.contextmanager
+def track_queries():
+    query_tally = QueryTally()
+    token = current_query_tally.set(query_tally)
+    try:
+        yield query_tally
+    finally:
+        current_query_tally.reset(token)
+
+@contextlib.contextmanager
+def measure_handler(consumer, message):
+    start = time.perf_counter()
+    with track_queries() as query_tally:
+        try:
+            yield query_tally
+        finally:
+            elapsed = time.perf_counter() - start
+            handler_seconds.observe(elapsed, consumer=consumer, message=message)
+            handler_queries.observe(query_tally.count, consumer=consumer, message=message)
+            handler_query_seconds.observe(query_tally.duration, consumer=consumer, message=message)
+            logger.debug('%s %s: %d queries, %.1fms in the database, %.1fms total', consumer, message, query_tally.count, 1000 * query_tally.duration, 1000 * elapsed)
+            for observer in list(handler_observers):
+                observer(consumer, message, query_tally)
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+@contextlib.contextmanager
+def query_budgets(budgets):
+    worst = {}
+
+    def check_budget(consumer, message, query_tally):
+        for key in (f'{consumer}.{message}', message):
+            if key in budgets:
+                if query_tally.count > budgets[key] and query_tally.count > worst.get(key, 0):
+                    worst[key] = query_tally.count
+                break
+
+    handler_observers.append(check_budget)
+    try:
+        yield worst
+    finally:
+        handler_observers.remove(check_budget)
+    if worst:
+        raise QueryBudgetExceeded('Query budgets exceeded: ' + ', '.join(f'{key} used {count} queries (budget {budgets[key]})' for (key, count) in sorted(worst.items())))
+
+class QueryCountMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with track_queries() as query_tally:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+        view_name = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        view_seconds.observe(elapsed, view=view_name)
+        view_queries.observe(query_tally.count, view=view_name)
+        logger.debug('%s: %d queries, %.1fms in the database, %.1fms total', view_name, query_tally.count, 1000 * query_tally.duration, 1000 * elapsed)
+        if settings.QUERY_COUNT_DEBUG:
+            response['X-Query-Count'] = str(query_tally.count)
+            response['X-Query-Time'] = f'{1000 * query_tally.duration:.1f}ms'
+        return response
+
+def record_email(kind, sent):
+    emails.inc(kind=kind, outcome='sent' if sent else 'failed')
+
+class InstrumentedConsumerMixin:
+    metrics_name = None
+    metrics_messages = ()
+    metrics_open = False
+    refused = False
+
+    def message_name(self, content):
+        if content is None:
+            return 'info'
+        if isinstance(content, dict):
+            for message in self.metrics_messages:
+                if message in content:
+                    return message
+        return 'other'
+
+    async def websocket_connect(self, message):
+        from . import drain
+        if drain.draining:
+            drain.refused_sockets.inc(consumer=self.metrics_name)
+            self.refused = True
+            await self.close()
+            return
+        await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None, headers=None):
+        from .drain import register_consumer
+        from .stalls import start_stall_detector
+        start_stall_detector()
+        await super().accept(subprotocol, headers)
+        register_consumer(self)
+        if not self.metrics_open:
+            self.metrics_open = True
+            open_sockets.inc(consumer=self.metrics_name)
+
+    async def websocket_disconnect(self, message):
+        from .drain import unregister_consumer
+        if self.refused:
+            raise StopConsumer()
+        unregister_consumer(self)
+        if self.metrics_open:
+            self.metrics_open = False
+            open_sockets.dec(consumer=self.metrics_name)
+        await super().websocket_disconnect(message)
+
+    async def drain(self, delay):
+        await self.send_json({'reconnect': {'delay': delay}})
+        await self.close()
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if not text_data:
+            raise ValueError('No text section for incoming WebSocket frame!')
+        content = await self.decode_json(text_data)
+        message = self.message_name(content)
+        with measure_handler(self.metrics_name, message) as query_tally:
+            await self.receive_json(content, **kwargs)
+        if settings.QUERY_COUNT_DEBUG:
+            await self.send_json({'debug_queries': {'message': message, 'queries': query_tally.count, 'milliseconds': round(1000 * query_tally.duration, 1)}})
+
+    async def dispatch(self, message):
+        if message['type'].startswith('websocket.'):
+            await super().dispatch(message)
+            return
+        with measure_handler(self.metrics_name, message['type']):
+            await super().dispatch(message)
+
+    async def group_send(self, group, message):
+        group_sends.inc(consumer=self.metrics_name, type=message['type'])
+        await self.channel_layer.group_send(group, message)
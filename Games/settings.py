@@ -25,6 +25,49 @@ with open(secrets_path) as secrets_file:
 
 DEBUG = not IN_PRODUCTION
 
+QUERY_COUNT_DEBUG = getenv('DJANGO_QUERY_COUNT_DEBUG', 'FALSE') == 'TRUE'
+
+LOOP_STALL_THRESHOLD = float(getenv('DJANGO_LOOP_STALL_THRESHOLD', '0'))
+
+ENGINE_CONCURRENCY = int(getenv('DJANGO_ENGINE_CONCURRENCY', '4'))
+ENGINE_QUEUE_SIZE = int(getenv('DJANGO_ENGINE_QUEUE_SIZE', '64'))
+ENGINE_RETRY_AFTER = 2000
+ENGINE_HTTP_BUILD_CONCURRENCY = int(getenv('DJANGO_ENGINE_HTTP_BUILD_CONCURRENCY', '2'))
+ENGINE_OPERATION_TIMEOUT = float(getenv('DJANGO_ENGINE_OPERATION_TIMEOUT', '60'))
+ENGINE_OPERATION_CPU_LIMIT = float(getenv('DJANGO_ENGINE_OPERATION_CPU_LIMIT', '20'))
+ENGINE_QUARANTINE_TIMEOUT = 300
+ENGINE_MAX_ABANDONED_THREADS = int(getenv('DJANGO_ENGINE_MAX_ABANDONED_THREADS', '8'))
+ENGINE_WAIT_THREADS = int(getenv('DJANGO_ENGINE_WAIT_THREADS', '16'))
+
+ENGINE_WARMUP_MATCHES = int(getenv('DJANGO_ENGINE_WARMUP_MATCHES', '0'))
+ENGINE_WARMUP_DAYS = int(getenv('DJANGO_ENGINE_WARMUP_DAYS', '2'))
+ENGINE_WARMUP_PAUSE = 0.05
+ENGINE_WARMUP_TIMEOUT = 900
+
+DRAIN_SIGNAL = getenv('DJANGO_DRAIN_SIGNAL', 'SIGUSR1')
+DRAIN_RECONNECT_MIN_DELAY = 500
+DRAIN_RECONNECT_MAX_DELAY = 15000
+
+ENGINE_LEASE_TIMEOUT = 60
+ENGINE_FORWARD_TIMEOUT = 10
+
+MATCH_HEARTBEAT_INTERVAL = 25
+
+MATCH_STATE_MAX_AGE = 2
+COMPLETED_MATCH_STATE_MAX_AGE = 3600
+MATCH_SNAPSHOT_CACHE_TIMEOUT = 3600
+
+HISTORY_CHECKPOINT_INTERVAL = 20
+HISTORY_MAX_CHECKPOINTS = 50
+HISTORY_MAX_MOVES = 5000
+HISTORY_INDEX_CACHE_SIZE = 16
+HISTORY_STATE_CACHE_SIZE = 512
+
+WRITE_BEHIND_INTERVAL = 5
+WRITE_BEHIND_BATCH_SIZE = 500
+
+LOBBY_CATCHUP_LIMIT = 100
+
 if IN_PRODUCTION:
     ALLOWED_HOSTS = ['games.tabony.net', '208.113.131.91']
 else:
@@ -50,6 +93,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'Games.metrics.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,12 +132,14 @@ if IN_PRODUCTION:
             'BACKEND': 'channels_redis.core.RedisChannelLayer',
         }
     }
+    ENGINE_LEASES = 'Nations.leases.DatabaseEngineLeases'
 else:
     CHANNEL_LAYERS = {
         'default': {
             'BACKEND': 'channels.layers.InMemoryChannelLayer',
         }
     }
+    ENGINE_LEASES = 'Nations.leases.LocalEngineLeases'
 
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 
@@ -174,7 +220,7 @@ if IN_PRODUCTION:
         'disable_existing_loggers': False,
         'handlers': {
             'file': {
-                'level': 'WARNING',
+                'level': 'INFO',
                 'class': 'logging.FileHandler',
                 'filename': BASE_DIR.parent.parent.parent.parent / 'logs' / 'django.log',
             },
@@ -185,5 +231,15 @@ if IN_PRODUCTION:
                 'level': 'WARNING',
                 'propagate': True,
             },
+            'Games': {
+                'handlers': ['file'],
+                'level': 'WARNING',
+                'propagate': True,
+            },
+            'Nations': {
+                'handlers': ['file'],
+                'level': 'INFO',
+                'propagate': True,
+            },
         },
     }
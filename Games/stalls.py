@@ -0,0 +1,66 @@
+from django.conf import settings
+
+from .metrics import loop_lag_seconds, loop_stalls
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+logger = logging.getLogger(__name__)
+
+heartbeat_interval = 0.1
+detectors = weakref.WeakKeyDictionary()
+
+class StallDetector:
+    def __init__(self, loop, threshold):
+        self.loop = loop
+        self.threshold = threshold
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.reported = False
+        self.task = loop.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, name='loop-stall-watchdog', daemon=True).start()
+
+    async def heartbeat(self):
+        while True:
+            expected = time.monotonic() + heartbeat_interval
+            await asyncio.sleep(heartbeat_interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            loop_lag_seconds.observe(lag)
+            self.last_beat = now
+            if self.reported:
+                self.reported = False
+                logger.warning('Event loop stall ended after %.2fs', lag + heartbeat_interval)
+
+    def watch(self):
+        while not self.loop.is_closed() and not self.task.done():
+            time.sleep(heartbeat_interval)
+            stalled_for = time.monotonic() - self.last_beat
+            if stalled_for > self.threshold and not self.reported:
+                self.reported = True
+                loop_stalls.inc()
+                self.report(stalled_for)
+
+    def report(self, stalled_for):
+        frames = sys._current_frames()
+        lines = [f'Event loop stalled for {stalled_for:.2f}s running {asyncio.current_task(self.loop)!r}']
+        if self.loop_thread_id in frames:
+            lines.append('Loop thread:')
+            lines += traceback.format_stack(frames[self.loop_thread_id])
+        for thread in threading.enumerate():
+            if thread.name.startswith('nations-engine-') and thread.ident in frames:
+                lines.append(f'{thread.name}:')
+                lines += traceback.format_stack(frames[thread.ident])
+        logger.warning(''.join(line if line.endswith('\n') else line + '\n' for line in lines))
+
+def start_stall_detector():
+    if settings.LOOP_STALL_THRESHOLD <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    if loop not in detectors:
+        detectors[loop] = StallDetector(loop, settings.LOOP_STALL_THRESHOLD)
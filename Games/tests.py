@@ -0,0 +1,25 @@
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.test import SimpleTestCase
+
+from . import drain, routing
+
+class DrainTests(SimpleTestCase):
+    def setUp(self):
+        drain.draining = True
+
+    def tearDown(self):
+        drain.draining = False
+
+    async def test_refused_connect_disconnects_cleanly(self):
+        application = URLRouter(routing.websocket_urlpatterns)
+        for path in ('/ws/', '/ws/nations/', '/ws/nations/1/'):
+            with self.subTest(path=path):
+                refused = drain.refused_sockets.values.copy()
+                communicator = WebsocketCommunicator(application, path)
+                communicator.scope['user'] = AnonymousUser()
+                (connected, close_code) = await communicator.connect()
+                self.assertFalse(connected)
+                await communicator.disconnect()
+                self.assertEqual(sum(drain.refused_sockets.values.values()), sum(refused.values()) + 1)
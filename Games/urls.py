@@ -15,6 +15,7 @@ urlpatterns = [
     path('accounts/', include('django.contrib.auth.urls')),
     path('accounts/profile/', views.profile, name='profile'),
     path('admin/', admin.site.urls),
+    path('metrics/', views.metrics, name='metrics'),
 ]
 
 if settings.IN_PRODUCTION:
@@ -15,6 +15,7 @@ from users.models import User, is_superuser
 from Nations.models import NationsPreferences, Match as NationsMatch, MatchPlayer as NationsMatchPlayer
 from Nations.forms import NationsPreferencesForm
 from Games.forms import UserCreationFormWithEmail, ProfileSettings
+from Games.metrics import record_email, render as render_metrics
 
 import datetime
 
@@ -66,15 +67,18 @@ Enjoy!
                 Source=settings.DEFAULT_FROM_EMAIL,
             )
         except Exception:
-            pass
+            record_email('welcome', False)
+        else:
+            record_email('welcome', True)
     else:
-        send_mail(
+        sent = send_mail(
             subject,
             body,
             None,
             [user.email],
             fail_silently=True
         )
+        record_email('welcome', sent > 0)
 
 def inform_me(user):
     subject = 'New registration at Tabony Games!'
@@ -105,15 +109,18 @@ def inform_me(user):
                 Source=settings.DEFAULT_FROM_EMAIL,
             )
         except Exception:
-            pass
+            record_email('registration', False)
+        else:
+            record_email('registration', True)
     else:
-        send_mail(
+        sent = send_mail(
             subject,
             body,
             None,
             [settings.HELP_EMAIL],
             fail_silently=True
         )
+        record_email('registration', sent > 0)
 
 def sign_up(request):
     if request.method == 'POST':
@@ -165,6 +172,11 @@ def profile(request):
         'nations_form': nations_form
     })
 
+@login_required
+@is_superuser
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 if settings.IN_PRODUCTION:
     def protected_static(request, path):
         response = HttpResponse(status=200)
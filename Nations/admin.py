@@ -1,9 +1,12 @@
 from django.contrib import admin
 
-from .models import Match, MatchPlayer, Tournament, NationsChat, NationsPreferences
+from .models import EngineLease, Match, MatchPlayer, MatchSnapshot, Tournament, TournamentStanding, NationsChat, NationsPreferences
 
 admin.site.register(Match)
 admin.site.register(MatchPlayer)
+admin.site.register(MatchSnapshot)
+admin.site.register(EngineLease)
 admin.site.register(Tournament)
+admin.site.register(TournamentStanding)
 admin.site.register(NationsChat)
 admin.site.register(NationsPreferences)
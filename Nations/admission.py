@@ -0,0 +1,90 @@
+from Games.metrics import Counter, Gauge
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import threading
+
+PLAYER = 0
+SPECTATOR = 1
+
+engine_admitted = Gauge('tabony_engine_admitted', 'Engine replays currently admitted.')
+engine_waiting = Gauge('tabony_engine_waiting', 'Engine replays waiting for admission.')
+engine_busy = Counter('tabony_engine_busy_total', 'Engine replays turned away because the wait queue was full.')
+
+class EngineBusy(Exception):
+    pass
+
+class EngineAdmission:
+    def __init__(self, limit, queue_size):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.admitted = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, priority):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority):
+        self.discard_cancelled()
+        if self.admitted < self.limit and not self.waiting:
+            self.admitted += 1
+            engine_admitted.set(self.admitted)
+            return
+        if len(self.waiting) >= self.queue_size:
+            worst = max(self.waiting)
+            if worst[0] <= priority:
+                engine_busy.inc(priority='player' if priority == PLAYER else 'spectator')
+                raise EngineBusy()
+            self.waiting.remove(worst)
+            heapq.heapify(self.waiting)
+            worst[2].set_exception(EngineBusy())
+            engine_busy.inc(priority='player' if worst[0] == PLAYER else 'spectator')
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.sequence), future))
+        engine_waiting.set(len(self.waiting))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release()
+            raise
+        finally:
+            engine_waiting.set(len(self.waiting))
+
+    def release(self):
+        self.admitted -= 1
+        while self.waiting and self.admitted < self.limit:
+            (_, _, future) = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                self.admitted += 1
+        engine_admitted.set(self.admitted)
+        engine_waiting.set(len(self.waiting))
+
+    def discard_cancelled(self):
+        waiting = [waiter for waiter in self.waiting if not waiter[2].done()]
+        if len(waiting) != len(self.waiting):
+            self.waiting = waiting
+            heapq.heapify(self.waiting)
+
+class EngineBuilds:
+    def __init__(self, limit):
+        self.slots = threading.BoundedSemaphore(limit)
+
+    @contextlib.contextmanager
+    def admit(self):
+        if not self.slots.acquire(blocking=False):
+            engine_busy.inc(priority='http')
+            raise EngineBusy()
+        try:
+            yield
+        finally:
+            self.slots.release()
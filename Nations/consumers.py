@@ -5,28 +5,48 @@ from django.conf import settings
 from django.urls import reverse
 from django.contrib.sites.models import Site
 from django.core.mail import send_mail
+from django.db.models import F
 from django.db.models.functions import Now
 from django.utils.timezone import make_aware
 from django.apps import apps
 
 from users.models import User, get_deleted_user
-from .models import Match, MatchPlayer, NationsChat
+from Games.metrics import Counter, InstrumentedConsumerMixin, state_queue_wait_seconds, record_email
+from .models import Match, MatchPlayer, MatchSnapshot, NationsChat
+from .standings import record_match_result
+from .admission import PLAYER, SPECTATOR, EngineAdmission, EngineBusy
+from .engines import EngineTimeout, TerminatePlay, ThreadState, adopt_warm_engine, engine_wait_executor, quarantine_remaining
+from .leases import engine_forwards, engine_lease_changes, engine_leases
+from .lobby import LOBBY_FEEDS, LOBBY_GROUP, get_lobby_cards, lobby_card_message
+from .snapshots import acache_match_snapshot, aget_cached_match_snapshot, chat_entry, get_notes_revision, store_match_snapshot
+from .writebehind import write_behind
 
 from . import nations
 
 import asyncio
 import json
 import datetime
-import threading
-import queue
+import logging
+import math
+import time
 
-class TerminatePlay(Exception):
+logger = logging.getLogger(__name__)
+
+engine_admission = EngineAdmission(settings.ENGINE_CONCURRENCY, settings.ENGINE_QUEUE_SIZE)
+
+invalid_moves = Counter('tabony_invalid_moves_total', 'Moves rejected on the event loop before reaching the engine, by reason.')
+stale_moves = Counter('tabony_stale_moves_total', 'Moves rejected because the match moved on, by where the version check caught them.')
+
+class StaleMove(Exception):
     pass
 
-class NationsConsumer(AsyncJsonWebsocketConsumer):
+class NationsConsumer(InstrumentedConsumerMixin, AsyncJsonWebsocketConsumer):
+    metrics_name = 'nations'
+
     async def connect(self):
         user = self.scope['user']
         self.user_group_name = None
+        self.lobby_feed = None
         if user.is_authenticated:
             user_id = user.pk
             self.user_group_name = f'nations_notifications_{user_id}'
@@ -36,6 +56,8 @@ class NationsConsumer(AsyncJsonWebsocketConsumer):
     async def disconnect(self, close_code):
         if self.user_group_name is not None:
             await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+        if self.lobby_feed is not None:
+            await self.channel_layer.group_discard(LOBBY_GROUP, self.channel_name)
 
     @database_sync_to_async
     def get_number_of_turns_from_db(self):
@@ -52,10 +74,45 @@ class NationsConsumer(AsyncJsonWebsocketConsumer):
         number_of_turns = await self.get_number_of_turns_from_db()
         await self.send_json({'turns': number_of_turns})
 
+    @database_sync_to_async
+    def get_lobby_cards_from_db(self, since):
+        archive_threshold = make_aware(datetime.datetime.now() - datetime.timedelta(days=7))
+        user = self.scope['user'] if self.lobby_feed == 'mine' else None
+        return get_lobby_cards(max(since, archive_threshold), user)
+
+    async def received_lobby(self, lobby):
+        try:
+            feed = lobby['feed']
+            since = datetime.datetime.fromisoformat(lobby['since'])
+        except (TypeError, KeyError, ValueError):
+            return
+        if feed not in LOBBY_FEEDS:
+            return
+        if since.tzinfo is None:
+            since = make_aware(since)
+        if self.lobby_feed is None:
+            await self.channel_layer.group_add(LOBBY_GROUP, self.channel_name)
+        self.lobby_feed = feed
+        cards = await self.get_lobby_cards_from_db(since)
+        if len(cards) > settings.LOBBY_CATCHUP_LIMIT:
+            await self.send_json({'lobby_reload': None})
+        elif cards:
+            await self.send_json({'lobby': cards})
+
+    async def lobby_card(self, event):
+        card = event['card']
+        username = self.scope['user'].username
+        if self.lobby_feed == 'mine' and username not in card['players'] and username != event['removed']:
+            return
+        await self.send_json({'lobby': [card]})
+
     async def receive_json(self, content):
         user = self.scope['user']
         if not user.is_authenticated:
             return
+        if isinstance(content, dict) and 'lobby' in content:
+            await self.received_lobby(content['lobby'])
+            return
         await self.send_turns_info()
 
 class MatchInfo:
@@ -70,6 +127,7 @@ class MatchInfo:
         self.korea_nerf = None
         self.lincoln_nerf = None
         self.players = None
+        self.match_players = None
         self.player_growth_resources = None
         self.replay = None
         self.prev_player = None
@@ -77,6 +135,8 @@ class MatchInfo:
         self.game_over = False
         self.log = None
         self.state = None
+        self.version = 0
+        self.frozen = False
 
     async def rules(self):
         rules = {'growth_resources': self.growth_resources}
@@ -89,21 +149,19 @@ class MatchInfo:
             rules['player_growth_resources'] = self.player_growth_resources
         return rules
 
-class ThreadState:
-    def __init__(self):
-        self.match_thread = None
-        self.move_queue = None
-        self.state_queue = None
-
-    def is_running(self):
-        return self.match_thread is not None and self.match_thread.is_alive()
+class NationsMatchConsumer(InstrumentedConsumerMixin, AsyncJsonWebsocketConsumer):
+    metrics_name = 'nations_match'
+    metrics_messages = ('resume', 'join', 'decline', 'move', 'chat', 'notes', 'resync', 'keepalive')
 
-class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
         self.match_info = MatchInfo(self.scope['url_route']['kwargs']['match_id'])
         self.thread_state = ThreadState()
+        self.owns_engine_lease = False
+        self.engine_owner = None
+        self.legal_moves_cache = (None, frozenset())
+        self.match_player_id = None
+        self.match_player_loaded = False
         self.sent_initial_info = False
-        self.avoid_duplicate_updates = False
         self.match_group_name = f'nations_match_{self.match_info.match_id}'
         await self.channel_layer.group_add(self.match_group_name, self.channel_name)
         user = self.scope['user']
@@ -113,10 +171,14 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
             self.user_group_name = f'nations_notifications_{user_id}'
             await self.channel_layer.group_add(self.user_group_name, self.channel_name)
         await self.accept()
+        self.heartbeat_task = asyncio.create_task(self.send_heartbeats())
 
     async def disconnect(self, close_code):
-        if self.thread_state.is_running():
-            self.thread_state.move_queue.put(TerminatePlay)
+        self.heartbeat_task.cancel()
+        self.stop_engine()
+        await self.release_engine_lease()
+        if self.match_player_id is not None:
+            await database_sync_to_async(write_behind.flush)([self.match_player_id])
         await self.channel_layer.group_discard(self.match_group_name, self.channel_name)
         if self.user_group_name is not None:
             await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
@@ -142,13 +204,13 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         try:
             match = Match.objects.get(match_id=self.match_info.match_id)
         except Match.DoesNotExist:
-            return (None, None, None)
-        match_players = match.players.all().order_by('pk')
+            return (None, None, None, None)
+        match_players = list(match.players.select_related('player').order_by('pk'))
         players = [match_player.player.username for match_player in match_players][:match.player_count]
-        return (match, players, match.current_player.username)
+        return (match, match_players, players, match.current_player.username)
 
     async def get_match(self):
-        (match, players, current_player) = await self.get_match_and_players_from_db()
+        (match, match_players, players, current_player) = await self.get_match_and_players_from_db()
         self.match_info.player_count = match.player_count
         self.match_info.growth_resources = match.growth_resources
         self.match_info.extra_draft_nations = match.extra_draft_nations
@@ -158,18 +220,15 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         self.match_info.korea_nerf = match.korea_nerf
         self.match_info.lincoln_nerf = match.lincoln_nerf
         self.match_info.players = players
+        self.match_info.match_players = match_players
         self.match_info.replay = match.replay.replace('\r', '').rstrip('\n')
         self.match_info.current_player = current_player
         self.match_info.game_over = match.game_over
+        self.match_info.version = match.version
         self.match_info.player_growth_resources = {player: await self.get_growth_resources_from_db(player) for player in players}
 
     @database_sync_to_async
     def save_match_to_db(self):
-        try:
-            match = Match.objects.get(match_id=self.match_info.match_id)
-        except Match.DoesNotExist:
-            return
-        match.replay = self.match_info.replay + '\n'
         if self.match_info.game_over:
             user = get_deleted_user()
         else:
@@ -177,14 +236,21 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
                 user = User.objects.get(username=self.match_info.current_player)
             except User.DoesNotExist:
                 user = get_deleted_user()
-        match.current_player = user
+        fields = {
+            'replay': self.match_info.replay + '\n',
+            'current_player': user,
+            'game_over': self.match_info.game_over,
+            'version': F('version') + 1,
+        }
         if self.match_info.state is not None:
-            match.current_player_order = ' '.join(self.match_info.state['player_order'])
-            match.current_round = self.match_info.state['round']
-        match.game_over = self.match_info.game_over
+            fields['current_player_order'] = ' '.join(self.match_info.state['player_order'])
+            fields['current_round'] = self.match_info.state['round']
         if self.match_info.prev_player != self.match_info.current_player:
-            match.new_turn = Now()
-        match.save()
+            fields['new_turn'] = Now()
+        if not Match.objects.filter(match_id=self.match_info.match_id, version=self.match_info.version).update(**fields):
+            return False
+        self.match_info.version += 1
+        return True
 
     @database_sync_to_async
     def save_player_info_to_db(self, username):
@@ -209,10 +275,46 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
             match_player.save()
 
     async def save_match(self):
-        await self.save_match_to_db()
+        if not await self.save_match_to_db():
+            stale_moves.inc(stage='save')
+            self.stop_engine()
+            self.match_info.state = None
+            raise StaleMove()
+        if self.thread_state.is_running():
+            self.thread_state.version = self.match_info.version
         if self.match_info.state is not None:
             for player in self.match_info.players:
                 await self.save_player_info_to_db(player)
+            if self.match_info.game_over:
+                await self.save_tournament_standings_to_db()
+                await self.freeze_match_snapshot_to_db()
+                self.match_info.frozen = True
+                self.stop_engine()
+                await self.release_engine_lease()
+
+    @database_sync_to_async
+    def freeze_match_snapshot_to_db(self):
+        snapshot = {
+            'players': self.match_info.players,
+            'accepted': self.match_info.players,
+            'growth_resources': self.match_info.player_growth_resources,
+            'state': self.match_info.state,
+            'log': self.match_info.log,
+            'version': self.match_info.version,
+        }
+        store_match_snapshot(self.match_info.match_id, snapshot)
+
+    @database_sync_to_async
+    def store_match_snapshot_to_db(self, snapshot):
+        store_match_snapshot(self.match_info.match_id, snapshot)
+
+    @database_sync_to_async
+    def get_stored_snapshot_from_db(self):
+        return MatchSnapshot.objects.filter(match_id=self.match_info.match_id, version=self.match_info.version).values_list('snapshot', flat=True).first()
+
+    @database_sync_to_async
+    def save_tournament_standings_to_db(self):
+        record_match_result(self.match_info.match_id)
 
     @database_sync_to_async
     def get_growth_resources_from_db(self, username):
@@ -256,7 +358,10 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         else:
             MatchPlayer.objects.create(match=match, player=player, growth_resources=growth_resources, accepted=True)
         match.new_turn = Now()
+        match.version = F('version') + 1
         match.save()
+        match.refresh_from_db(fields=['version'])
+        self.match_info.version = match.version
 
     @database_sync_to_async
     def remove_player_from_match_db(self, match, player):
@@ -266,78 +371,59 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
             return
         match_player.delete()
         match.new_turn = Now()
+        match.version = F('version') + 1
         match.save()
+        match.refresh_from_db(fields=['version'])
+        self.match_info.version = match.version
 
     @database_sync_to_async
-    def get_chat_log_from_db(self):
-        try:
-            match = Match.objects.get(match_id=self.match_info.match_id)
-        except Match.DoesNotExist:
-            return None
+    def get_version_from_db(self):
+        return Match.objects.filter(match_id=self.match_info.match_id).values_list('version', flat=True).first()
+
+    @database_sync_to_async
+    def get_match_player_from_db(self):
         user = self.scope['user']
-        if user.is_authenticated:
-            try:
-                match_player = match.players.get(player=user)
-            except MatchPlayer.DoesNotExist:
-                match_player = None
-        else:
-            match_player = None
-        chats = list(match.chats.all().order_by('pk'))
-        if match_player is not None and chats:
-            match_player.last_chat = chats[-1].pk
-            match_player.save()
-        chat_log = []
-        for chat in chats:
-            chat_log.append({'timestamp': chat.created.isoformat(), 'player': chat.player.username, 'message': chat.message})
-        return chat_log
+        if not user.is_authenticated:
+            return None
+        return MatchPlayer.objects.filter(match_id=self.match_info.match_id, player=user).first()
+
+    async def get_match_player_id(self):
+        if not self.match_player_loaded:
+            match_player = await self.get_match_player_from_db()
+            self.match_player_id = match_player.pk if match_player is not None else None
+            self.match_player_loaded = True
+        return self.match_player_id
 
     @database_sync_to_async
-    def save_chat_to_db(self, match, player, message):
-        chat = NationsChat.objects.create(match=match, player=player, message=message)
-        try:
-            match_player = match.players.get(player=player)
-        except MatchPlayer.DoesNotExist:
-            match_player = None
-        if match_player is not None:
-            match_player.last_chat = chat.pk
-            match_player.save()
-        return chat
+    def get_chat_log_from_db(self, after=0):
+        chats = NationsChat.objects.filter(match_id=self.match_info.match_id, pk__gt=after).select_related('player').order_by('pk')
+        return [chat_entry(chat) for chat in chats]
+
+    async def mark_chat_read(self, chat_id):
+        match_player_id = await self.get_match_player_id()
+        if match_player_id is not None:
+            write_behind.set_last_chat(match_player_id, chat_id)
 
     @database_sync_to_async
-    def get_notes_from_db(self):
-        user = self.scope['user']
-        if user.is_authenticated:
-            try:
-                match = Match.objects.get(match_id=self.match_info.match_id)
-            except Match.DoesNotExist:
-                match_player = None
-            try:
-                match_player = match.players.get(player=user)
-            except MatchPlayer.DoesNotExist:
-                match_player = None
-        else:
-            match_player = None
+    def save_chat_to_db(self, match, player, message):
+        return NationsChat.objects.create(match=match, player=player, message=message)
+
+    async def get_notes(self):
+        match_player = await self.get_match_player_from_db()
+        self.match_player_id = match_player.pk if match_player is not None else None
+        self.match_player_loaded = True
         if match_player is None:
             return ''
         return match_player.notes
 
     @database_sync_to_async
-    def save_notes_to_db(self, notes):
-        user = self.scope['user']
-        if user.is_authenticated:
-            try:
-                match = Match.objects.get(match_id=self.match_info.match_id)
-            except Match.DoesNotExist:
-                match_player = None
-            try:
-                match_player = match.players.get(player=user)
-            except MatchPlayer.DoesNotExist:
-                match_player = None
-        else:
-            match_player = None
-        if match_player is not None:
-            match_player.notes = notes[:4000]
-            match_player.save()
+    def save_notes_to_db(self, match_player_id, notes):
+        MatchPlayer.objects.filter(pk=match_player_id).update(notes=notes)
+
+    async def save_notes(self, notes):
+        match_player_id = await self.get_match_player_id()
+        if match_player_id is not None:
+            await self.save_notes_to_db(match_player_id, notes[:4000])
 
     @database_sync_to_async
     def get_number_of_turns_from_db(self):
@@ -347,61 +433,120 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         archive_threshold = make_aware(datetime.datetime.now() - datetime.timedelta(days=7))
         return len(Match.objects.filter(current_player=user, new_turn__gte=archive_threshold)) + len(MatchPlayer.objects.filter(player=user, accepted=False, match__new_turn__gte=archive_threshold))
 
-    def play_match(self):
-        def report_state(nations_match):
-            replay = nations_match.get_replay().replace('\r', '').rstrip('\n')
-            log = nations_match.get_log().replace('\r', '').rstrip('\n')
-            state = nations_match.get_state()
-            self.thread_state.state_queue.put((replay, log, state))
+    async def wait_for_state(self):
+        start = time.perf_counter()
+        try:
+            (self.match_info.replay, self.match_info.log, self.match_info.state) = await asyncio.get_running_loop().run_in_executor(engine_wait_executor, self.thread_state.wait_for_state)
+        except EngineTimeout:
+            self.thread_state = ThreadState()
+            self.match_info.state = None
+            await self.release_engine_lease()
+            raise
+        state_queue_wait_seconds.observe(time.perf_counter() - start)
 
-        def move_getter(choice, options, undo):
-            while True:
-                report_state(nations_match)
-                next_move = self.thread_state.move_queue.get()
-                if next_move is TerminatePlay:
-                    raise TerminatePlay()
-                if next_move is not None:
-                    break
-            move_strings = [str(option) for option in options]
-            if next_move in move_strings:
-                move = options[move_strings.index(next_move)]
-            else:
-                move = next_move
-            next_move = None
-            return move
+    def stop_engine(self):
+        self.thread_state.stop()
+        self.thread_state = ThreadState()
 
-        nations_match = nations.Match(move_getter=move_getter, replay=self.match_info.replay)
-        try:
-            nations_match.play()
-        except TerminatePlay:
+    async def acquire_engine_lease(self):
+        owner = await database_sync_to_async(engine_leases.acquire)(self.match_info.match_id, self.channel_name, settings.ENGINE_LEASE_TIMEOUT)
+        if owner == self.channel_name and not self.owns_engine_lease:
+            engine_lease_changes.inc(change='acquired' if self.engine_owner is None else 'taken_over')
+        self.owns_engine_lease = owner == self.channel_name
+        return owner
+
+    async def release_engine_lease(self):
+        if not self.owns_engine_lease:
             return
-        except Exception:
-            import traceback
-            traceback.print_exc()
-        while True:
-            report_state(nations_match)
-            next_move = self.thread_state.move_queue.get()
-            if next_move is TerminatePlay:
-                return
+        self.owns_engine_lease = False
+        engine_lease_changes.inc(change='released')
+        await database_sync_to_async(engine_leases.release)(self.match_info.match_id, self.channel_name)
+        await self.group_send(self.match_group_name, {'type': 'engine_released', 'owner': self.channel_name})
+
+    async def engine_released(self, event):
+        if self.engine_owner == event['owner']:
+            self.engine_owner = None
+
+    async def request_from_engine_owner(self, owner, message):
+        reply_channel = await self.channel_layer.new_channel()
+        await self.channel_layer.send(owner, dict(message, reply_channel=reply_channel))
+        try:
+            reply = await asyncio.wait_for(self.channel_layer.receive(reply_channel), settings.ENGINE_FORWARD_TIMEOUT)
+        except asyncio.TimeoutError:
+            engine_forwards.inc(type=message['type'], outcome='timeout')
+            return None
+        engine_forwards.inc(type=message['type'], outcome='replied')
+        return reply
+
+    def follow_engine_state(self, owner, version, log, state):
+        self.engine_owner = owner
+        self.match_info.version = version
+        self.match_info.log = log
+        self.match_info.state = state
+        self.match_info.current_player = state['next_move_player']
+        self.match_info.game_over = state['game_over']
+
+    async def follow_engine(self):
+        owner = await self.acquire_engine_lease()
+        if owner == self.channel_name:
+            return False
+        snapshot = await aget_cached_match_snapshot(self.match_info.match_id, self.match_info.version) or await self.get_stored_snapshot_from_db()
+        if snapshot is not None:
+            self.follow_engine_state(owner, snapshot['version'], snapshot['log'], snapshot['state'])
+            return True
+        reply = await self.request_from_engine_owner(owner, {'type': 'engine_state_request', 'version': self.match_info.version})
+        if reply is not None and reply['state'] is not None and reply['version'] >= self.match_info.version:
+            self.follow_engine_state(owner, reply['version'], reply['log'], reply['state'])
+            return True
+        raise EngineBusy()
+
+    def engine_priority(self):
+        user = self.scope['user']
+        if user.is_authenticated and self.match_info.players and user.username in self.match_info.players:
+            return PLAYER
+        return SPECTATOR
 
     async def get_match_info(self):
-        if self.match_info.replay and self.match_info.state and self.thread_state.is_running():
+        if self.match_info.replay and self.match_info.state and (self.thread_state.is_running() or self.match_info.frozen or self.engine_owner is not None):
             return
+        self.engine_owner = None
         await self.get_match()
+        if self.match_info.game_over:
+            snapshot = await self.get_stored_snapshot_from_db()
+            if snapshot is not None:
+                self.stop_engine()
+                self.match_info.state = snapshot['state']
+                self.match_info.log = snapshot['log']
+                self.match_info.current_player = snapshot['state']['next_move_player']
+                self.match_info.frozen = True
+                return
         if not self.match_info.replay and len(await self.get_accepted_players_from_db()) == self.match_info.player_count:
-            await self.create_match()
+            async with engine_admission.admit(PLAYER):
+                await self.create_match()
             await self.get_match()
         replay = self.match_info.replay
         state = self.match_info.state
         if (replay and not state) or (replay and state and not self.thread_state.is_running()):
+            if self.thread_state.is_running() and self.thread_state.version != self.match_info.version:
+                self.stop_engine()
             if not self.thread_state.is_running():
-                self.thread_state.move_queue = queue.SimpleQueue()
-                self.thread_state.state_queue = queue.SimpleQueue()
-                self.thread_state.match_thread = threading.Thread(target=self.play_match)
-                self.thread_state.match_thread.start()
+                if await self.follow_engine():
+                    return
+                warm_engine = adopt_warm_engine(self.match_info.match_id, self.match_info.version)
+                if warm_engine is not None:
+                    self.thread_state = warm_engine.thread_state
+                    (self.match_info.replay, self.match_info.log, self.match_info.state) = warm_engine.state
+                else:
+                    async with engine_admission.admit(self.engine_priority()):
+                        try:
+                            self.thread_state.start(self.match_info.match_id, self.match_info.replay, self.match_info.version)
+                        except EngineTimeout:
+                            await self.release_engine_lease()
+                            raise
+                        await self.wait_for_state()
             else:
                 self.thread_state.move_queue.put(None)
-            (self.match_info.replay, self.match_info.log, self.match_info.state) = self.thread_state.state_queue.get()
+                await self.wait_for_state()
             self.match_info.current_player = self.match_info.state['next_move_player']
             self.match_info.game_over = self.match_info.state['game_over']
 
@@ -421,12 +566,13 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         self.match_info.game_over = self.match_info.state['game_over']
         await self.save_match()
         await self.notify()
+        await self.publish_match_card('started')
 
     async def make_move(self, move):
         if not self.thread_state.is_running():
             await self.get_match_info()
         self.thread_state.move_queue.put(move)
-        (self.match_info.replay, self.match_info.log, self.match_info.state) = self.thread_state.state_queue.get()
+        await self.wait_for_state()
         self.match_info.prev_player = self.match_info.current_player
         self.match_info.current_player = self.match_info.state['next_move_player']
         self.match_info.game_over = self.match_info.state['game_over']
@@ -435,7 +581,33 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         if not self.sent_initial_info:
             await self.send_chat_log()
             await self.send_notes()
-            await self.send_match_info()
+            await self.send_match_info(cache_snapshot=True)
+        await self.send_turns_info()
+
+    async def received_resume(self, resume):
+        try:
+            version = int(resume['version'])
+            last_chat = int(resume['chat'])
+            notes_revision = int(resume['notes'])
+        except (TypeError, KeyError, ValueError):
+            await self.received_info_request()
+            return
+        current_version = await self.get_version_from_db()
+        if current_version is None or version > current_version:
+            await self.received_info_request()
+            return
+        chat_log = await self.get_chat_log_from_db(last_chat)
+        if chat_log:
+            await self.send_json({'chat_log_append': chat_log})
+            await self.mark_chat_read(chat_log[-1]['id'])
+        if get_notes_revision(await self.get_notes()) != notes_revision:
+            await self.send_notes()
+        if version == current_version:
+            self.match_info.version = current_version
+        else:
+            await self.send_match_info(cache_snapshot=True)
+        self.sent_initial_info = True
+        await self.send_json({'resumed': {'version': current_version}})
         await self.send_turns_info()
 
     async def received_join(self, join_info):
@@ -452,11 +624,12 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         growth_resources = self.match_info.growth_resources if self.match_info.growth_resources > 0 else join_info
         match = await self.get_match_from_db()
         await self.add_player_to_match_db(match, user, growth_resources)
-        await self.send_match_info()
-        self.avoid_duplicate_updates = True
-        group_message = {'type': 'state_change_message', 'move': None}
-        await self.channel_layer.group_send(self.match_group_name, group_message)
-        await self.channel_layer.group_send(f'nations_notifications_{user.pk}', {'type': 'new_turn'})
+        self.match_player_loaded = False
+        await self.send_match_info(cache_snapshot=True)
+        group_message = {'type': 'state_change_message', 'move': None, 'version': self.match_info.version}
+        await self.group_send(self.match_group_name, group_message)
+        await self.group_send(f'nations_notifications_{user.pk}', {'type': 'new_turn'})
+        await self.publish_match_card('joined')
 
     async def received_decline(self):
         match = await self.get_match_from_db()
@@ -464,28 +637,124 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         if not user.is_authenticated:
             return
         await self.remove_player_from_match_db(match, user)
-        await self.send_match_info()
-        self.avoid_duplicate_updates = True
-        group_message = {'type': 'state_change_message', 'move': None}
-        await self.channel_layer.group_send(self.match_group_name, group_message)
-        await self.channel_layer.group_send(f'nations_notifications_{user.pk}', {'type': 'new_turn'})
+        self.match_player_loaded = False
+        await self.send_match_info(cache_snapshot=True)
+        group_message = {'type': 'state_change_message', 'move': None, 'version': self.match_info.version}
+        await self.group_send(self.match_group_name, group_message)
+        await self.group_send(f'nations_notifications_{user.pk}', {'type': 'new_turn'})
+        await self.publish_match_card('declined', user.username)
 
-    async def received_move(self, move):
-        await self.get_match_info()
+    async def received_move(self, move, version=None):
         user = self.scope['user']
         if not user.is_authenticated:
             return
+        if version is not None and (version != self.match_info.version or self.match_info.state is None):
+            current_version = await self.get_version_from_db()
+            if version != current_version:
+                stale_moves.inc(stage='received')
+                await self.send_stale_move(current_version)
+                return
+            if version != self.match_info.version:
+                self.engine_owner = None
+                self.match_info.state = None
+        await self.get_match_info()
+        if version is not None and version != self.match_info.version:
+            stale_moves.inc(stage='received')
+            await self.send_stale_move()
+            return
         username = user.username
         is_superuser = user.is_superuser
-        if not self.match_info.game_over and (username == self.match_info.current_player or is_superuser):
-            await self.make_move(move)
-            await self.save_match()
-            await self.send_match_info()
-            self.avoid_duplicate_updates = True
-            group_message = {'type': 'state_change_message', 'move': move}
-            await self.channel_layer.group_send(self.match_group_name, group_message)
-            if self.match_info.prev_player != self.match_info.current_player:
-                await self.notify()
+        reason = self.invalid_move_reason(move, username, is_superuser)
+        if reason is not None:
+            invalid_moves.inc(reason=reason)
+            await self.send_invalid_move(reason)
+            return
+        if self.engine_owner is not None:
+            version = self.match_info.version
+            reply = await self.request_from_engine_owner(self.engine_owner, {'type': 'engine_move', 'move': move, 'version': version, 'username': username, 'is_superuser': is_superuser})
+            if reply is not None:
+                if not reply['applied']:
+                    await self.send_stale_move()
+                return
+            if await self.acquire_engine_lease() != self.channel_name:
+                raise EngineBusy()
+            self.engine_owner = None
+            self.match_info.state = None
+            await self.get_match_info()
+            if self.match_info.version != version or self.match_info.game_over or not (username == self.match_info.current_player or is_superuser):
+                await self.send_match_info()
+                return
+        await self.apply_move(move)
+
+    def legal_moves(self):
+        (version, moves) = self.legal_moves_cache
+        if version != self.match_info.version:
+            state = self.match_info.state
+            moves = {str(option) for option in state['next_move_options']}
+            if state.get('undo_allowed'):
+                moves.add('UNDO')
+            moves = frozenset(moves)
+            self.legal_moves_cache = (self.match_info.version, moves)
+        return moves
+
+    def invalid_move_reason(self, move, username, is_superuser):
+        if self.match_info.state is None:
+            return 'not_started'
+        if self.match_info.game_over:
+            return 'game_over'
+        if is_superuser:
+            return None
+        if username != self.match_info.current_player:
+            return 'turn'
+        if not isinstance(move, str) or move not in self.legal_moves():
+            return 'option'
+        return None
+
+    async def apply_move(self, move):
+        await self.make_move(move)
+        await self.save_match()
+        await self.send_match_info(cache_snapshot=True)
+        group_message = {'type': 'state_change_message', 'move': move, 'version': self.match_info.version, 'owner': self.channel_name, 'log': self.match_info.log, 'state': self.match_info.state}
+        await self.group_send(self.match_group_name, group_message)
+        if self.match_info.prev_player != self.match_info.current_player:
+            await self.notify()
+        if self.match_info.game_over:
+            await self.publish_match_card('finished')
+        elif self.match_info.prev_player != self.match_info.current_player:
+            await self.publish_match_card('turn')
+
+    async def engine_move(self, event):
+        reply = {'type': 'engine_move_result', 'applied': False}
+        try:
+            if self.owns_engine_lease:
+                await self.get_match_info()
+                if event['version'] == self.match_info.version and not self.match_info.game_over and (event['username'] == self.match_info.current_player or event['is_superuser']):
+                    await self.apply_move(event['move'])
+                    reply['applied'] = True
+        except (EngineBusy, EngineTimeout, StaleMove):
+            pass
+        reply['version'] = self.match_info.version
+        await self.channel_layer.send(event['reply_channel'], reply)
+
+    async def engine_state_request(self, event):
+        reply = {'type': 'engine_state', 'version': self.match_info.version, 'log': None, 'state': None}
+        try:
+            if self.owns_engine_lease:
+                if event['version'] > self.match_info.version:
+                    self.match_info.state = None
+                await self.get_match_info()
+                if self.owns_engine_lease and self.match_info.state is not None:
+                    reply.update(version=self.match_info.version, log=self.match_info.log, state=self.match_info.state)
+        except (EngineBusy, EngineTimeout, StaleMove):
+            pass
+        await self.channel_layer.send(event['reply_channel'], reply)
+
+    async def resync_match_info(self):
+        version = await self.get_version_from_db()
+        if self.engine_owner is not None or (version is not None and version > self.match_info.version):
+            self.engine_owner = None
+            self.match_info.state = None
+        await self.send_match_info(cache_snapshot=True)
 
     async def received_chat(self, chat):
         match = await self.get_match_from_db()
@@ -493,17 +762,32 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         if not user.is_authenticated:
             return
         chat_object = await self.save_chat_to_db(match, user, chat)
-        group_message = {'type': 'chat_message', 'timestamp': chat_object.created.isoformat(), 'player': user.username, 'chat': chat}
-        await self.channel_layer.group_send(self.match_group_name, group_message)
+        await self.mark_chat_read(chat_object.pk)
+        group_message = {'type': 'chat_message', 'id': chat_object.pk, 'timestamp': chat_object.created.isoformat(), 'player': user.username, 'chat': chat}
+        await self.group_send(self.match_group_name, group_message)
 
     async def received_notes(self, notes):
-        await self.save_notes_to_db(notes)
+        await self.save_notes(notes)
         message = {
-            'ack_notes': None
+            'ack_notes': None,
+            'notes_revision': get_notes_revision(notes[:4000])
         }
         await self.send_json(message)
 
     async def receive_json(self, content):
+        try:
+            await self.received_message(content)
+        except EngineBusy:
+            await self.send_busy()
+        except EngineTimeout:
+            await self.send_engine_error()
+        except StaleMove:
+            await self.send_stale_move()
+
+    async def received_message(self, content):
+        if isinstance(content, dict) and 'resume' in content:
+            await self.received_resume(content['resume'])
+            return
         if not self.scope['user'].is_authenticated:
             await self.received_info_request()
             return
@@ -514,30 +798,51 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
         elif 'decline' in content:
             await self.received_decline()
         elif 'move' in content:
-            await self.received_move(content['move'])
+            version = content.get('version')
+            await self.received_move(content['move'], version if isinstance(version, int) else None)
         elif 'chat' in content:
             await self.received_chat(content['chat'])
         elif 'notes' in content:
             await self.received_notes(content['notes'])
+        elif 'resync' in content:
+            await self.resync_match_info()
         elif 'keepalive' in content:
             await self.send_keepalive()
 
     async def state_change_message(self, event):
-        if self.avoid_duplicate_updates:
-            self.avoid_duplicate_updates = False
+        version = event['version']
+        if version <= self.match_info.version:
             return
         self.match_info.state = None
-        if event['move'] is not None:
-            await self.make_move(event['move'])
-        await self.send_match_info()
+        self.match_info.frozen = False
+        try:
+            if event.get('state') is not None:
+                self.stop_engine()
+                await self.release_engine_lease()
+                self.follow_engine_state(event['owner'], version, event['log'], event['state'])
+                self.match_info.frozen = self.match_info.game_over
+            await self.send_match_info()
+        except EngineBusy:
+            await self.send_busy()
+        except EngineTimeout:
+            await self.send_engine_error()
+        except StaleMove:
+            await self.send_stale_move()
 
     async def new_turn(self, event):
         await self.send_turns_info()
 
-    async def send_match_info(self):
+    async def send_match_info(self, cache_snapshot=False):
         await self.get_match_info()
         if self.match_info.players is None:
             return
+        message = await self.match_info_message()
+        await self.send_json(message)
+        if cache_snapshot and self.match_info.state is not None:
+            await acache_match_snapshot(self.match_info.match_id, message)
+        self.sent_initial_info = True
+
+    async def match_info_message(self):
         replay = self.match_info.replay
         players = self.match_info.players
         player_growth_resources = self.match_info.player_growth_resources
@@ -551,9 +856,16 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
             'growth_resources': player_growth_resources,
             'state': self.match_info.state,
             'log': self.match_info.log,
+            'version': self.match_info.version,
         }
-        await self.send_json(message)
-        self.sent_initial_info = True
+        return message
+
+    async def drain(self, delay):
+        if self.thread_state.is_running() and self.match_info.players is not None and self.match_info.state is not None:
+            await self.store_match_snapshot_to_db(await self.match_info_message())
+        self.stop_engine()
+        await self.release_engine_lease()
+        await super().drain(delay)
 
     async def send_turns_info(self):
         number_of_turns = await self.get_number_of_turns_from_db()
@@ -561,11 +873,81 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
 
     async def send_chat_log(self):
         chat_log = await self.get_chat_log_from_db()
+        if chat_log:
+            await self.mark_chat_read(chat_log[-1]['id'])
         message = {
             'chat_log': chat_log
         }
         await self.send_json(message)
 
+    async def send_busy(self):
+        message = {
+            'busy': {
+                'retry_after': settings.ENGINE_RETRY_AFTER
+            }
+        }
+        await self.send_json(message)
+
+    async def send_engine_error(self):
+        quarantine = quarantine_remaining(self.match_info.match_id)
+        message = {
+            'engine_error': {
+                'retry_after': math.ceil(1000 * quarantine) if quarantine > 0 else settings.ENGINE_RETRY_AFTER
+            }
+        }
+        await self.send_json(message)
+
+    async def send_invalid_move(self, reason):
+        message = {
+            'invalid_move': {
+                'reason': reason,
+                'version': self.match_info.version
+            }
+        }
+        await self.send_json(message)
+
+    async def send_stale_move(self, version=None):
+        message = {
+            'stale_move': {
+                'version': self.match_info.version if version is None else version
+            }
+        }
+        await self.send_json(message)
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(settings.MATCH_HEARTBEAT_INTERVAL)
+            try:
+                await self.renew_engine_lease()
+            except Exception:
+                logger.exception('Could not renew the engine lease for match %s, dropping the engine', self.match_info.match_id)
+            try:
+                version = await self.get_version_from_db()
+            except Exception:
+                logger.exception('Could not read the version of match %s for a heartbeat', self.match_info.match_id)
+                version = None
+            message = {
+                'heartbeat': {
+                    'version': version if version is not None else self.match_info.version,
+                    'interval': settings.MATCH_HEARTBEAT_INTERVAL * 1000
+                }
+            }
+            await self.send_json(message)
+
+    async def renew_engine_lease(self):
+        if not self.owns_engine_lease:
+            return
+        try:
+            owner = await self.acquire_engine_lease()
+        except Exception:
+            engine_lease_changes.inc(change='renewal_failed')
+            self.owns_engine_lease = False
+            self.stop_engine()
+            raise
+        if owner != self.channel_name:
+            engine_lease_changes.inc(change='lost')
+            self.stop_engine()
+
     async def send_keepalive(self):
         message = {
             'keepalive': None
@@ -575,30 +957,41 @@ class NationsMatchConsumer(AsyncJsonWebsocketConsumer):
     async def chat_message(self, event):
         message = {
             'chat': {
+                'id': event['id'],
                 'timestamp': event['timestamp'],
                 'player': event['player'],
                 'message': event['chat']
             }
         }
         await self.send_json(message)
-        await self.get_chat_log_from_db()
+        await self.mark_chat_read(event['id'])
 
     async def send_notes(self):
-        notes = await self.get_notes_from_db()
+        notes = await self.get_notes()
         message = {
-            'notes': notes
+            'notes': notes,
+            'notes_revision': get_notes_revision(notes)
         }
         await self.send_json(message)
 
     async def notify(self):
         if self.match_info.prev_player is not None:
             prev_player_user = await self.get_user_from_db(self.match_info.prev_player)
-            await self.channel_layer.group_send(f'nations_notifications_{prev_player_user.pk}', {'type': 'new_turn'})
+            await self.group_send(f'nations_notifications_{prev_player_user.pk}', {'type': 'new_turn'})
         current_player_user = await self.get_user_from_db(self.match_info.current_player)
-        await self.channel_layer.group_send(f'nations_notifications_{current_player_user.pk}', {'type': 'new_turn'})
+        await self.group_send(f'nations_notifications_{current_player_user.pk}', {'type': 'new_turn'})
         event_loop = asyncio.get_event_loop()
         event_loop.create_task(self.notify_user(self.match_info.current_player))
 
+    @database_sync_to_async
+    def get_lobby_card_message_from_db(self, event, removed, match_players):
+        match = Match.objects.select_related('current_player').get(match_id=self.match_info.match_id)
+        return lobby_card_message(match, event, removed, match_players)
+
+    async def publish_match_card(self, event, removed=None):
+        match_players = self.match_info.match_players if event in ('started', 'turn', 'finished') else None
+        await self.group_send(LOBBY_GROUP, await self.get_lobby_card_message_from_db(event, removed, match_players))
+
     @database_sync_to_async
     def notify_user(self, username):
         try:
@@ -641,12 +1034,15 @@ It's your turn in https://{hostname}{match_url}
                     Source=settings.DEFAULT_FROM_EMAIL,
                 )
             except Exception:
-                pass
+                record_email('turn', False)
+            else:
+                record_email('turn', True)
         else:
-            send_mail(
+            sent = send_mail(
                 subject,
                 body,
                 None,
                 [user.email],
                 fail_silently=True
             )
+            record_email('turn', sent > 0)
@@ -0,0 +1,239 @@
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from Games.metrics import Counter, Gauge, engine_threads
+from .models import Match
+from .replays import TerminatePlay, clean_replay
+from .snapshots import cache_match_snapshot, match_snapshot
+
+from . import nations
+
+import concurrent.futures
+import ctypes
+import datetime
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+engine_timeouts = Counter('tabony_engine_timeouts_total', 'Engine operations abandoned by the watchdog, by the budget they exceeded.')
+abandoned_engine_threads = Gauge('tabony_engine_abandoned_threads', 'Engine threads abandoned by the watchdog that are still running.')
+warm_engine_count = Gauge('tabony_warm_engines', 'Engine threads pre-built at startup and not yet adopted by a consumer.')
+warm_engine_outcomes = Counter('tabony_warm_engines_total', 'Pre-built engine threads by outcome.')
+
+def play_match(replay, move_queue, state_queue):
+    def report_state(nations_match):
+        replay = clean_replay(nations_match.get_replay())
+        log = clean_replay(nations_match.get_log())
+        state = nations_match.get_state()
+        state_queue.put((replay, log, state))
+
+    def move_getter(choice, options, undo):
+        while True:
+            report_state(nations_match)
+            next_move = move_queue.get()
+            if next_move is TerminatePlay:
+                raise TerminatePlay()
+            if next_move is not None:
+                break
+        move_strings = [str(option) for option in options]
+        if next_move in move_strings:
+            move = options[move_strings.index(next_move)]
+        else:
+            move = next_move
+        next_move = None
+        return move
+
+    engine_threads.inc()
+    try:
+        nations_match = nations.Match(move_getter=move_getter, replay=replay)
+        try:
+            nations_match.play()
+        except TerminatePlay:
+            return
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        while True:
+            report_state(nations_match)
+            next_move = move_queue.get()
+            if next_move is TerminatePlay:
+                return
+    finally:
+        engine_threads.dec()
+
+class EngineTimeout(Exception):
+    pass
+
+engine_poll_interval = 0.1
+quarantined_matches = {}
+quarantined_matches_lock = threading.Lock()
+abandoned_threads = []
+abandoned_threads_lock = threading.Lock()
+engine_wait_executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.ENGINE_WAIT_THREADS, thread_name_prefix='nations-engine-wait')
+
+def quarantine_remaining(match_id):
+    now = time.monotonic()
+    with quarantined_matches_lock:
+        for (quarantined_id, until) in list(quarantined_matches.items()):
+            if until <= now:
+                del quarantined_matches[quarantined_id]
+        return quarantined_matches.get(int(match_id), now) - now
+
+def is_quarantined(match_id):
+    return quarantine_remaining(match_id) > 0
+
+def count_abandoned_threads():
+    with abandoned_threads_lock:
+        abandoned_threads[:] = [thread for thread in abandoned_threads if thread.is_alive()]
+        abandoned_engine_threads.set(len(abandoned_threads))
+        return len(abandoned_threads)
+
+def thread_cpu_time(thread):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (AttributeError, OSError):
+        return None
+
+class ThreadState:
+    def __init__(self):
+        self.match_thread = None
+        self.move_queue = None
+        self.state_queue = None
+        self.version = None
+        self.match_id = None
+        self.replay_length = 0
+
+    def is_running(self):
+        return self.match_thread is not None and self.match_thread.is_alive()
+
+    def start(self, match_id, replay, version):
+        if is_quarantined(match_id):
+            raise EngineTimeout()
+        if count_abandoned_threads() >= settings.ENGINE_MAX_ABANDONED_THREADS:
+            logger.error('Refusing to start an engine for match %s: %d abandoned engine threads are still running, restart this worker', match_id, len(abandoned_threads))
+            raise EngineTimeout()
+        self.match_id = match_id
+        self.replay_length = replay.count('\n') + 1
+        self.move_queue = queue.SimpleQueue()
+        self.state_queue = queue.SimpleQueue()
+        self.match_thread = threading.Thread(target=play_match, args=(replay, self.move_queue, self.state_queue), name=f'nations-engine-{match_id}')
+        self.match_thread.start()
+        self.version = version
+
+    def stop(self):
+        if self.is_running():
+            self.move_queue.put(TerminatePlay)
+
+    def wait_for_state(self):
+        deadline = time.monotonic() + settings.ENGINE_OPERATION_TIMEOUT
+        start_cpu = thread_cpu_time(self.match_thread)
+        while True:
+            try:
+                return self.state_queue.get(timeout=engine_poll_interval)
+            except queue.Empty:
+                pass
+            if not self.is_running():
+                if not self.state_queue.empty():
+                    continue
+                self.abandon('stopped')
+            elif time.monotonic() > deadline:
+                self.abandon('wall')
+            elif start_cpu is not None and (thread_cpu_time(self.match_thread) or start_cpu) - start_cpu > settings.ENGINE_OPERATION_CPU_LIMIT:
+                self.abandon('cpu')
+
+    def abandon(self, budget):
+        engine_timeouts.inc(budget=budget)
+        logger.warning('Abandoning the engine for match %s after exceeding its %s budget (replay of %d lines)', self.match_id, budget, self.replay_length)
+        if budget != 'stopped':
+            with quarantined_matches_lock:
+                quarantined_matches[int(self.match_id)] = time.monotonic() + settings.ENGINE_QUARANTINE_TIMEOUT
+        if self.is_running():
+            # Only delivered once the thread runs Python bytecode again, so a thread looping in native code leaks.
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.match_thread.ident), ctypes.py_object(TerminatePlay))
+            self.move_queue.put(TerminatePlay)
+            with abandoned_threads_lock:
+                abandoned_threads.append(self.match_thread)
+        raise EngineTimeout()
+
+class WarmEngine:
+    def __init__(self, thread_state, state):
+        self.thread_state = thread_state
+        self.state = state
+        self.expires = time.monotonic() + settings.ENGINE_WARMUP_TIMEOUT
+
+warm_engines = {}
+warm_engines_lock = threading.Lock()
+
+def adopt_warm_engine(match_id, version):
+    with warm_engines_lock:
+        warm_engine = warm_engines.pop(int(match_id), None)
+        warm_engine_count.set(len(warm_engines))
+    if warm_engine is None:
+        return None
+    if warm_engine.thread_state.version != version or not warm_engine.thread_state.is_running():
+        warm_engine.thread_state.stop()
+        warm_engine_outcomes.inc(outcome='stale')
+        return None
+    warm_engine_outcomes.inc(outcome='adopted')
+    return warm_engine
+
+def expire_warm_engines():
+    now = time.monotonic()
+    with warm_engines_lock:
+        expired = [match_id for (match_id, warm_engine) in warm_engines.items() if warm_engine.expires <= now]
+        expired = [warm_engines.pop(match_id) for match_id in expired]
+        warm_engine_count.set(len(warm_engines))
+        next_expiry = min((warm_engine.expires for warm_engine in warm_engines.values()), default=None)
+    for warm_engine in expired:
+        warm_engine.thread_state.stop()
+        warm_engine_outcomes.inc(outcome='expired')
+    return next_expiry
+
+def warm_up_match(match):
+    thread_state = ThreadState()
+    thread_state.start(match.match_id, match.replay, match.version)
+    (replay, log, state) = thread_state.wait_for_state()
+    cache_match_snapshot(match.match_id, match_snapshot(match, list(match.players.select_related('player').order_by('pk')), state, log))
+    if state['game_over']:
+        thread_state.stop()
+        return
+    with warm_engines_lock:
+        previous = warm_engines.get(match.match_id)
+        warm_engines[match.match_id] = WarmEngine(thread_state, (replay, log, state))
+        warm_engine_count.set(len(warm_engines))
+    if previous is not None:
+        previous.thread_state.stop()
+
+def warm_up_engines():
+    start = time.perf_counter()
+    try:
+        threshold = timezone.now() - datetime.timedelta(days=settings.ENGINE_WARMUP_DAYS)
+        matches = list(Match.objects.filter(game_over=False, new_turn__gte=threshold).exclude(replay='').order_by('-new_turn')[:settings.ENGINE_WARMUP_MATCHES])
+        logger.info('Warming up %d engines', len(matches))
+        for (i, match) in enumerate(matches, 1):
+            try:
+                warm_up_match(match)
+            except EngineTimeout:
+                pass
+            except Exception:
+                logger.exception('Could not warm up the engine for match %d', match.match_id)
+            if i % 10 == 0 or i == len(matches):
+                logger.info('Warmed up %d/%d engines in %.1fs', i, len(matches), time.perf_counter() - start)
+            time.sleep(settings.ENGINE_WARMUP_PAUSE)
+    finally:
+        connection.close()
+    while (next_expiry := expire_warm_engines()) is not None:
+        time.sleep(max(0, next_expiry - time.monotonic()))
+
+warmup_thread = None
+
+def start_engine_warmup():
+    global warmup_thread
+    if settings.ENGINE_WARMUP_MATCHES <= 0 or warmup_thread is not None:
+        return
+    warmup_thread = threading.Thread(target=warm_up_engines, name='nations-engine-warmup', daemon=True)
+    warmup_thread.start()
@@ -116,20 +116,126 @@ class ManageTournamentForm(forms.ModelForm):
             except (ValueError, TypeError):
                 self.add_error(field, 'Invalid input.')
                 continue
+            matches = Match.objects.only('match_id', 'tournament').in_bulk(match_ids)
             for match_id in match_ids:
-                try:
-                    match = Match.objects.get(match_id=match_id)
-                except Match.DoesNotExist:
+                match = matches.get(match_id)
+                if match is None:
                     self.add_error(field, f'Invalid match ID: {match_id}')
                     break
-                if field == 'add_matches' and match.tournament is not None:
+                if field == 'add_matches' and match.tournament_id is not None:
                     self.add_error(field, f'Match already included in a tournament: {match_id}')
                     break
-                if field == 'remove_matches' and (match.tournament is None or match.tournament != self.instance):
+                if field == 'remove_matches' and (match.tournament_id is None or match.tournament_id != self.instance.pk):
                     self.add_error(field, f'Match not included in this tournament: {match_id}')
                     break
             self.cleaned_data[field] = match_ids
 
+class CreateTournamentRoundForm(forms.Form):
+    title = forms.CharField(label='Match Title Prefix', required=False, max_length=200, widget=forms.TextInput(attrs={'onkeydown': 'return event.key != \'Enter\';'}))
+    players = forms.CharField(label='Players (one per line, in seeding order)', widget=forms.Textarea())
+    player_count = forms.ChoiceField(
+        label='Players per Match',
+        choices=(
+            ('2', '2'),
+            ('3', '3'),
+            ('4', '4'),
+            ('5', '5'),
+            ('6', '6')
+        ),
+        initial='4',
+        widget=forms.Select(attrs={'class': 'form-select', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+    seating = forms.ChoiceField(
+        label='Seating',
+        choices=(
+            ('listed', 'In Listed Order'),
+            ('seeded', 'Spread Seeds Across Matches'),
+            ('standings', 'By Current Standings'),
+            ('random', 'Random')
+        ),
+        initial='listed',
+        widget=forms.Select(attrs={'class': 'form-select', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+    growth_resources = forms.ChoiceField(
+        label='Growth Resources',
+        choices=(
+            ('1', '1 - Emperor'),
+            ('2', '2 - King'),
+            ('3', '3 - Prince'),
+            ('4', '4 - Chieftain'),
+            ('-1', 'Player Choice')
+        ),
+        initial='2',
+        widget=forms.Select(attrs={'class': 'form-select', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+    extra_draft_nations = forms.ChoiceField(
+        label='Extra Nations to Draft From',
+        choices=(
+            ('0', '+0 (One Nation Per Player Total)'),
+            ('1', '+1'),
+            ('2', '+2'),
+            ('3', '+3'),
+            ('4', '+4'),
+            ('5', '+5'),
+            ('6', '+6'),
+            ('-1', 'All Nations Available')
+        ),
+        initial='1',
+        widget=forms.Select(attrs={'class': 'form-select', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+    resource_remainder_tiebreaker = forms.BooleanField(
+        required=False,
+        label='Resource Remainder as Tiebreaker',
+        initial=True,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+    weighted_card_draw = forms.BooleanField(
+        required=False,
+        label='Weighted Card Draw',
+        initial=True,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+    korea_nerf = forms.BooleanField(
+        required=False,
+        label='Korea Nerf',
+        initial=True,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+    lincoln_nerf = forms.BooleanField(
+        required=False,
+        label='Lincoln Nerf',
+        initial=True,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+    invite_players = forms.BooleanField(
+        required=False,
+        label='Invite players (otherwise they are seated directly, unless they choose their growth resources)',
+        initial=True,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input', 'onkeydown': 'return event.key != \'Enter\';'})
+    )
+
+    def clean(self):
+        for field in ('player_count', 'growth_resources', 'extra_draft_nations'):
+            try:
+                self.cleaned_data[field] = int(self.cleaned_data[field])
+            except (ValueError, TypeError, KeyError):
+                self.add_error(field, 'Invalid choice.')
+        player_names = re.findall(r'\w+', self.cleaned_data.get('players', ''))
+        duplicates = sorted(set(player_name for player_name in player_names if player_names.count(player_name) > 1))
+        if duplicates:
+            self.add_error('players', f'Duplicate usernames: {", ".join(duplicates)}')
+        users = {user.username: user for user in User.objects.filter(username__in=player_names)}
+        missing = [player_name for player_name in player_names if player_name not in users]
+        if missing:
+            self.add_error('players', f'No players with these usernames: {", ".join(missing)}')
+        player_count = self.cleaned_data.get('player_count')
+        if not player_names:
+            self.add_error('players', 'No players listed.')
+        elif isinstance(player_count, int) and len(player_names) % player_count != 0:
+            self.add_error('players', f'{len(player_names)} players cannot be split evenly into {player_count}-player matches.')
+        self.cleaned_data['players'] = [users[player_name] for player_name in player_names if player_name in users]
+        return self.cleaned_data
+
 class NationsPreferencesForm(forms.ModelForm):
     class Meta:
         model = NationsPreferences
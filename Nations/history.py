@@ -0,0 +1,172 @@
+from django.conf import settings
+
+from . import nations
+from .replays import TerminatePlay, clean_replay, stop_at_next_choice
+
+import collections
+import contextlib
+import json
+import math
+import threading
+
+class HistoryUnavailable(Exception):
+    pass
+
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.values = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.values:
+                return None
+            self.values.move_to_end(key)
+            return self.values[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.size:
+                self.values.popitem(last=False)
+
+def state_delta(old, new):
+    delta = {}
+    removed = [key for key in old if key not in new]
+    if removed:
+        delta['removed'] = removed
+    for (key, value) in new.items():
+        if key in old and old[key] == value:
+            continue
+        if key in old and isinstance(old[key], dict) and isinstance(value, dict):
+            delta.setdefault('nested', {})[key] = state_delta(old[key], value)
+        else:
+            delta.setdefault('set', {})[key] = value
+    return delta
+
+def apply_state_delta(state, delta):
+    state = dict(state)
+    for key in delta.get('removed', ()):
+        del state[key]
+    state.update(delta.get('set', {}))
+    for (key, nested) in delta.get('nested', {}).items():
+        state[key] = apply_state_delta(state[key], nested)
+    return state
+
+def match_rules(match, match_players):
+    rules = {'growth_resources': match.growth_resources}
+    if match.extra_draft_nations != 0:
+        rules['extra_draft_nations'] = match.extra_draft_nations
+    for house_rule in ('resource_remainder_tiebreaker', 'card_draw_limits', 'weighted_card_draw', 'korea_nerf', 'lincoln_nerf'):
+        if getattr(match, house_rule):
+            rules[house_rule] = True
+    if match.growth_resources < 0:
+        rules['player_growth_resources'] = {match_player.player.username: match_player.growth_resources for match_player in match_players}
+    return rules
+
+def replay_header_length(players, rules):
+    nations_match = nations.Match(player_names=players, move_getter=stop_at_next_choice, rules=rules)
+    try:
+        nations_match.play()
+    except TerminatePlay:
+        pass
+    return len(clean_replay(nations_match.get_replay()).split('\n'))
+
+class HistoryIndex:
+    def __init__(self, replay, header_length, interval):
+        lines = clean_replay(replay).split('\n')
+        moves = lines[header_length:]
+        self.interval = interval
+        self.checkpoints = []
+        self.deltas = []
+        previous = None
+
+        def record(state):
+            nonlocal previous
+            state = json.loads(json.dumps(state))
+            if len(self.deltas) % interval == 0:
+                self.checkpoints.append(state)
+            self.deltas.append(None if previous is None else state_delta(previous, state))
+            previous = state
+
+        def move_getter(choice, options, undo):
+            record(nations_match.get_state())
+            if len(self.deltas) > len(moves):
+                raise TerminatePlay()
+            next_move = moves[len(self.deltas) - 1]
+            move_strings = [str(option) for option in options]
+            if next_move in move_strings:
+                return options[move_strings.index(next_move)]
+            return next_move
+
+        nations_match = nations.Match(move_getter=move_getter, replay='\n'.join(lines[:header_length]))
+        try:
+            nations_match.play()
+        except TerminatePlay:
+            pass
+        else:
+            record(nations_match.get_state())
+        if clean_replay(nations_match.get_replay()) != '\n'.join(lines):
+            raise HistoryUnavailable('Replaying the moves one at a time did not reproduce the stored replay.')
+        self.moves = len(self.deltas) - 1
+
+    def state_at(self, move):
+        checkpoint = move // self.interval
+        state = self.checkpoints[checkpoint]
+        for delta in self.deltas[checkpoint * self.interval + 1:move + 1]:
+            state = apply_state_delta(state, delta)
+        return state
+
+history_indexes = LRUCache(settings.HISTORY_INDEX_CACHE_SIZE)
+history_states = LRUCache(settings.HISTORY_STATE_CACHE_SIZE)
+build_locks = {}
+build_locks_lock = threading.Lock()
+
+@contextlib.contextmanager
+def build_lock(key):
+    with build_locks_lock:
+        (lock, users) = build_locks.get(key) or (threading.Lock(), 0)
+        build_locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with build_locks_lock:
+            (lock, users) = build_locks[key]
+            if users == 1:
+                del build_locks[key]
+            else:
+                build_locks[key] = (lock, users - 1)
+
+def get_history_index(match, match_players, admit=contextlib.nullcontext):
+    key = (match.match_id, match.version)
+    history_index = history_indexes.get(key)
+    if history_index is not None:
+        return history_index
+    with build_lock(key):
+        history_index = history_indexes.get(key)
+        if history_index is None:
+            with admit():
+                players = [match_player.player.username for match_player in match_players][:match.player_count]
+                rules = match_rules(match, match_players)
+                header_length = replay_header_length(players, rules)
+                moves = len(clean_replay(match.replay).split('\n')) - header_length
+                if moves > settings.HISTORY_MAX_MOVES:
+                    raise HistoryUnavailable(f'History is only kept for matches of up to {settings.HISTORY_MAX_MOVES} moves.')
+                interval = max(settings.HISTORY_CHECKPOINT_INTERVAL, math.ceil(moves / settings.HISTORY_MAX_CHECKPOINTS))
+                history_index = HistoryIndex(match.replay, header_length, interval)
+                history_indexes.set(key, history_index)
+    return history_index
+
+def get_historical_state(match, match_players, move, admit=contextlib.nullcontext):
+    key = (match.match_id, match.version, move)
+    entry = history_states.get(key)
+    if entry is None:
+        history_index = get_history_index(match, match_players, admit)
+        if move > history_index.moves:
+            return (None, history_index.moves)
+        entry = (history_index.state_at(move), history_index.moves)
+        history_states.set(key, entry)
+    return entry
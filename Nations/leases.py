@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from Games.metrics import Counter
+from .models import EngineLease
+
+import datetime
+import threading
+import time
+
+engine_lease_changes = Counter('tabony_engine_lease_changes_total', 'Engine lease acquisitions, releases and takeovers of expired leases.')
+engine_forwards = Counter('tabony_engine_forwards_total', 'Moves and state requests forwarded to the engine lease owner by outcome.')
+
+class LocalEngineLeases:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.leases = {}
+
+    def acquire(self, match_id, owner, timeout):
+        now = time.monotonic()
+        with self.lock:
+            (holder, expires) = self.leases.get(int(match_id), (None, now))
+            if holder is None or holder == owner or expires <= now:
+                self.leases[int(match_id)] = (owner, now + timeout)
+                return owner
+            return holder
+
+    def release(self, match_id, owner):
+        with self.lock:
+            if self.leases.get(int(match_id), (None, None))[0] == owner:
+                del self.leases[int(match_id)]
+
+class DatabaseEngineLeases:
+    def acquire(self, match_id, owner, timeout):
+        now = timezone.now()
+        expires = now + datetime.timedelta(seconds=timeout)
+        if EngineLease.objects.filter(match_id=match_id).filter(Q(owner=owner) | Q(expires__lte=now)).update(owner=owner, expires=expires):
+            return owner
+        (lease, created) = EngineLease.objects.get_or_create(match_id=match_id, defaults={'owner': owner, 'expires': expires})
+        return lease.owner
+
+    def release(self, match_id, owner):
+        EngineLease.objects.filter(match_id=match_id, owner=owner).delete()
+
+engine_leases = import_string(settings.ENGINE_LEASES)()
@@ -0,0 +1,117 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Prefetch
+
+from Games.metrics import Counter
+from .models import Match, MatchPlayer
+from .writebehind import write_behind
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOBBY_GROUP = 'nations_lobby'
+LOBBY_FEEDS = ('open', 'mine')
+
+lobby_cards = Counter('tabony_lobby_cards_total', 'Match cards published to the lobby feed, by event.')
+
+class MatchProperties:
+    growth_resources_descriptions = {
+        1: 'Emperor',
+        2: 'King',
+        3: 'Prince',
+        4: 'Chieftain',
+        -1: 'Variable Growth Resources'
+    }
+
+    def __init__(self, match, match_player=None, match_players=None):
+        self._match_id = match.match_id
+        self.title = match.title
+        self.player_count = match.player_count
+        self.growth_resources = match.growth_resources
+        self.match_type = f'{self.player_count}-Player, {self.growth_resources_descriptions[self.growth_resources]}'
+        house_rules = []
+        if match.extra_draft_nations != 0:
+            if match.extra_draft_nations < 0:
+                house_rules.append('Draft-from-All')
+            else:
+                house_rules.append(f'+{match.extra_draft_nations} Draft')
+        if match.resource_remainder_tiebreaker:
+            house_rules.append('Tiebreaker')
+        if match.card_draw_limits:
+            house_rules.append('Card Draw Limits')
+        if match.weighted_card_draw:
+            house_rules.append('Card Draw')
+        if match.korea_nerf:
+            house_rules.append('Korea Nerf')
+        if match.lincoln_nerf:
+            house_rules.append('Lincoln Nerf')
+        self.house_rules = ', '.join(house_rules)
+        if match_players is None:
+            match_players = list(match.players.select_related('player').order_by('pk'))
+        self.players = [player.player.username for player in match_players]
+        self.current_player = match.current_player.username if match.replay.strip() and not match.game_over else None
+        self.invited = [player.player.username for player in match_players if not player.accepted]
+        self.full = len(match_players) == match.player_count
+        self.game_over = match.game_over
+        self._new_turn = match.new_turn
+        self.new_turn_iso = match.new_turn.isoformat()
+        self.last_chat_seen = True
+        if match_player is not None:
+            try:
+                last_chat = match.chats.latest('pk')
+            except ObjectDoesNotExist:
+                last_chat = None
+            if last_chat is not None:
+                last_chat_id = last_chat.pk
+                self.last_chat_seen = last_chat_id <= write_behind.last_chat(match_player)
+
+    def get_match_id(self):
+        return self._match_id
+
+    def get_new_turn(self):
+        return self._new_turn
+
+    match_id = property(get_match_id)
+    new_turn = property(get_new_turn)
+
+def match_card(match, match_players=None):
+    properties = MatchProperties(match, match_players=match_players)
+    return {
+        'match_id': properties.match_id,
+        'title': properties.title,
+        'match_type': properties.match_type,
+        'house_rules': properties.house_rules,
+        'players': properties.players,
+        'invited': properties.invited,
+        'current_player': properties.current_player,
+        'full': properties.full,
+        'game_over': properties.game_over,
+        'new_turn': properties.new_turn_iso
+    }
+
+def lobby_card_message(match, event, removed=None, match_players=None):
+    lobby_cards.inc(event=event)
+    return {'type': 'lobby_card', 'card': match_card(match, match_players), 'removed': removed}
+
+def with_match_players(matches):
+    return matches.select_related('current_player').prefetch_related(Prefetch('players', queryset=MatchPlayer.objects.select_related('player').order_by('pk')))
+
+def get_lobby_cards(since, user=None):
+    matches = with_match_players(Match.objects.filter(new_turn__gt=since)).order_by('new_turn')
+    if user is not None:
+        matches = matches.filter(players__player=user)
+    return [match_card(match, list(match.players.all())) for match in matches[:settings.LOBBY_CATCHUP_LIMIT + 1]]
+
+def publish_match_cards(match_ids, event):
+    def publish():
+        group_send = async_to_sync(get_channel_layer().group_send)
+        try:
+            for match in with_match_players(Match.objects.filter(match_id__in=match_ids)):
+                group_send(LOBBY_GROUP, lobby_card_message(match, event, match_players=list(match.players.all())))
+        except Exception:
+            logger.exception('Could not publish lobby cards for matches %s', match_ids)
+    transaction.on_commit(publish)
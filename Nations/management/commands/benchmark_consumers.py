@@ -0,0 +1,357 @@
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from Games.metrics import QueryBudgetExceeded, query_budgets
+from users.models import User, get_deleted_user
+from Nations.models import Match, MatchPlayer
+
+import asyncio
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+
+class QueryCounter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.count += 1
+                self.duration += elapsed
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+def percentile(sorted_samples, fraction):
+    return sorted_samples[min(len(sorted_samples) - 1, round(fraction * (len(sorted_samples) - 1)))]
+
+class BenchmarkSocket:
+    def __init__(self, benchmark, path, user):
+        self.benchmark = benchmark
+        self.path = path
+        self.user = user
+        self.communicator = None
+        self.reader = None
+        self.waiters = []
+        self.state = None
+        self.version = None
+        self.last_chat = 0
+        self.notes_revision = 0
+
+    async def connect(self):
+        self.communicator = WebsocketCommunicator(self.benchmark.application, self.path)
+        self.communicator.scope['user'] = self.user
+        (connected, subprotocol) = await self.communicator.connect(timeout=self.benchmark.timeout)
+        if not connected:
+            raise RuntimeError(f'Could not connect to {self.path}')
+        self.reader = asyncio.create_task(self.read())
+
+    async def disconnect(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        if self.communicator is not None:
+            await self.communicator.disconnect(timeout=self.benchmark.timeout)
+            self.communicator = None
+
+    async def read(self):
+        while True:
+            try:
+                frame = await self.communicator.receive_json_from(timeout=self.benchmark.receive_timeout)
+            except AssertionError:
+                return
+            self.benchmark.frames_received += 1
+            if isinstance(frame, dict) and frame.get('state'):
+                self.state = frame['state']
+            if isinstance(frame, dict) and 'version' in frame:
+                self.version = frame['version']
+            if isinstance(frame, dict) and 'notes_revision' in frame:
+                self.notes_revision = frame['notes_revision']
+            if isinstance(frame, dict) and frame.get('chat'):
+                self.last_chat = max(self.last_chat, frame['chat']['id'])
+            for chat in (frame.get('chat_log') or frame.get('chat_log_append') or []) if isinstance(frame, dict) else []:
+                self.last_chat = max(self.last_chat, chat['id'])
+            if isinstance(frame, dict) and frame.get('busy'):
+                self.benchmark.busy_frames += 1
+                asyncio.get_running_loop().call_later(frame['busy']['retry_after'] * (1 + self.benchmark.random.random()) / 1000, self.retry)
+            if isinstance(frame, dict) and frame.get('stale_move'):
+                self.benchmark.stale_frames += 1
+                if frame['stale_move']['version'] != self.version:
+                    self.retry()
+            if isinstance(frame, dict) and frame.get('invalid_move'):
+                self.benchmark.invalid_frames += 1
+                self.retry()
+            for waiter in list(self.waiters):
+                (predicate, future) = waiter
+                if not future.done() and predicate(frame):
+                    future.set_result(frame)
+                    self.waiters.remove(waiter)
+
+    def retry(self):
+        if self.communicator is not None:
+            asyncio.create_task(self.communicator.send_json_to(None))
+
+    async def request(self, kind, content, predicate):
+        future = asyncio.get_running_loop().create_future()
+        waiter = (predicate, future)
+        self.waiters.append(waiter)
+        start = time.perf_counter()
+        await self.communicator.send_json_to(content)
+        self.benchmark.messages_sent += 1
+        try:
+            await asyncio.wait_for(future, self.benchmark.timeout)
+        except asyncio.TimeoutError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            self.benchmark.timeouts[kind] = self.benchmark.timeouts.get(kind, 0) + 1
+            return None
+        self.benchmark.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+        return future.result()
+
+    async def sync(self, kind='info'):
+        return await self.request(kind, None, lambda frame: isinstance(frame, dict) and 'turns' in frame)
+
+    async def reconnect(self):
+        start = time.perf_counter()
+        await self.disconnect()
+        await self.connect()
+        if self.benchmark.options['resume'] and self.version is not None:
+            await self.request('reconnect_sync', {'resume': {'version': self.version, 'chat': self.last_chat, 'notes': self.notes_revision}}, lambda frame: isinstance(frame, dict) and 'turns' in frame)
+        else:
+            await self.sync('reconnect_sync')
+        self.benchmark.latencies.setdefault('reconnect', []).append(time.perf_counter() - start)
+
+class Benchmark:
+    def __init__(self, options):
+        from Games import routing
+        self.application = URLRouter(routing.websocket_urlpatterns)
+        self.options = options
+        self.random = random.Random(options['seed'])
+        self.timeout = options['timeout']
+        self.receive_timeout = options['duration'] + 10 * options['timeout']
+        self.query_counter = QueryCounter()
+        self.latencies = {}
+        self.timeouts = {}
+        self.messages_sent = 0
+        self.frames_received = 0
+        self.busy_frames = 0
+        self.stale_frames = 0
+        self.invalid_frames = 0
+        self.moves = 0
+        self.sockets = []
+        self.deadline = None
+
+    def interval(self, mean):
+        if mean <= 0:
+            return float('inf')
+        return self.random.expovariate(1 / mean)
+
+    async def open_socket(self, path, user):
+        socket = BenchmarkSocket(self, path, user)
+        await socket.connect()
+        self.sockets.append(socket)
+        return socket
+
+    async def run_match_player(self, socket):
+        username = socket.user.username
+        next_chat = time.monotonic() + self.interval(self.options['chat_interval'])
+        next_reconnect = time.monotonic() + self.interval(self.options['reconnect_interval'])
+        while time.monotonic() < self.deadline:
+            state = socket.state
+            now = time.monotonic()
+            if state and not state['game_over'] and state['next_move_player'] == username:
+                options = [option for option in state['next_move_options'] if option not in ('UNDO', 'Resign')] or state['next_move_options']
+                if options:
+                    await asyncio.sleep(self.options['move_delay'])
+                    socket.state = None
+                    frame = await socket.request('move', {'move': self.random.choice(options), 'version': socket.version}, lambda frame: isinstance(frame, dict) and bool(frame.get('state') or frame.get('stale_move') or frame.get('invalid_move')))
+                    if frame is not None and not frame.get('stale_move') and not frame.get('invalid_move'):
+                        self.moves += 1
+                    continue
+            if now >= next_chat:
+                token = f'benchmark {self.random.getrandbits(32):08x}'
+                await socket.request('chat', {'chat': token}, lambda frame: isinstance(frame, dict) and 'chat' in frame and frame['chat']['message'] == token)
+                next_chat = now + self.interval(self.options['chat_interval'])
+            elif now >= next_reconnect:
+                await socket.reconnect()
+                next_reconnect = now + self.interval(self.options['reconnect_interval'])
+            else:
+                await asyncio.sleep(0.05)
+
+    async def run_polling_socket(self, socket, kind):
+        next_reconnect = time.monotonic() + self.interval(self.options['reconnect_interval'])
+        while time.monotonic() < self.deadline:
+            await asyncio.sleep(min(self.interval(self.options['poll_interval']), max(0, self.deadline - time.monotonic())))
+            if time.monotonic() >= self.deadline:
+                break
+            if time.monotonic() >= next_reconnect:
+                await socket.reconnect()
+                next_reconnect = time.monotonic() + self.interval(self.options['reconnect_interval'])
+            else:
+                await socket.sync(kind)
+
+    async def run_match(self, match_id, users, spectators):
+        path = f'/ws/nations/{match_id}/'
+        player_sockets = []
+        for user in users:
+            socket = await self.open_socket(path, user)
+            await socket.sync('initial_sync')
+            player_sockets.append(socket)
+        spectator_sockets = []
+        for i in range(spectators):
+            socket = await self.open_socket(path, AnonymousUser())
+            await socket.sync('initial_sync')
+            spectator_sockets.append(socket)
+        tasks = [self.run_match_player(socket) for socket in player_sockets]
+        tasks += [self.run_polling_socket(socket, 'spectator_info') for socket in spectator_sockets]
+        if self.options['notification_sockets']:
+            for user in users:
+                tasks.append(self.run_polling_socket(await self.open_socket('/ws/nations/', user), 'nations_turns'))
+                tasks.append(self.run_polling_socket(await self.open_socket('/ws/', user), 'games_turns'))
+        await asyncio.gather(*tasks)
+
+    async def run(self, matches):
+        self.deadline = time.monotonic() + self.options['duration']
+        try:
+            await asyncio.gather(*[self.run_match(match_id, users, self.options['spectators']) for (match_id, users) in matches])
+        finally:
+            for socket in self.sockets:
+                await socket.disconnect()
+
+def create_matches(options):
+    no_one = get_deleted_user()
+    player_count = options['players']
+    users = User.objects.bulk_create([
+        User(username=f'bench_{i}', email=f'bench_{i}@games.tabony.net', password='!')
+        for i in range(options['matches'] * player_count)
+    ])
+    matches = Match.objects.bulk_create([
+        Match(title=f'Benchmark {i}', player_count=player_count, current_player=no_one)
+        for i in range(options['matches'])
+    ])
+    MatchPlayer.objects.bulk_create([
+        MatchPlayer(match=match, player=user, growth_resources=match.growth_resources, accepted=True)
+        for (i, match) in enumerate(matches)
+        for user in users[i * player_count:(i + 1) * player_count]
+    ])
+    return [(match.match_id, users[i * player_count:(i + 1) * player_count]) for (i, match) in enumerate(matches)]
+
+class Command(BaseCommand):
+    help = 'Load test the websocket consumers in-process with the in-memory channel layer and a throwaway database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--matches', type=int, default=10, help='Number of concurrent matches.')
+        parser.add_argument('--players', type=int, default=4, choices=range(2, 7), help='Players per match.')
+        parser.add_argument('--spectators', type=int, default=2, help='Anonymous spectator sockets per match.')
+        parser.add_argument('--duration', type=float, default=30.0, help='Seconds to run after connecting.')
+        parser.add_argument('--move-delay', type=float, default=0.5, help='Seconds a player waits before making a move on their turn.')
+        parser.add_argument('--chat-interval', type=float, default=20.0, help='Mean seconds between chats per player (0 disables).')
+        parser.add_argument('--poll-interval', type=float, default=10.0, help='Mean seconds between info requests per spectator and notification socket.')
+        parser.add_argument('--reconnect-interval', type=float, default=0.0, help='Mean seconds between reconnects per socket (0 disables).')
+        parser.add_argument('--no-notification-sockets', dest='notification_sockets', action='store_false', help='Do not open NationsConsumer and GamesConsumer sockets for each player.')
+        parser.add_argument('--no-resume', dest='resume', action='store_false', help='Reconnect with a full info request instead of resuming.')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for a reply before counting a timeout.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--tracemalloc', action='store_true', help='Trace Python allocations to report peak traced memory (slower).')
+        parser.add_argument('--output', help='Also write the results as JSON to this file.')
+        parser.add_argument('--query-budget', action='append', default=[], metavar='HANDLER=QUERIES', help='Fail if any single message to this handler (e.g. move or nations_match.chat) issues more queries.')
+
+    def handle(self, *args, **options):
+        budgets = {}
+        for budget in options['query_budget']:
+            (handler, _, queries) = budget.partition('=')
+            if not queries.isdigit():
+                raise CommandError(f'Invalid query budget: {budget}')
+            budgets[handler] = int(queries)
+        budget_error = None
+        database = connections['default']
+        test_database_file = None
+        if database.vendor == 'sqlite':
+            (handle, test_database_file) = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(handle)
+            database.settings_dict['TEST']['NAME'] = test_database_file
+        channel_layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1000}}}
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(CHANNEL_LAYERS=channel_layers):
+                matches = create_matches(options)
+                benchmark = Benchmark(options)
+                for connection in connections.all(initialized_only=True):
+                    benchmark.query_counter.install(None, connection)
+                connection_created.connect(benchmark.query_counter.install, weak=False)
+                if options['tracemalloc']:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                try:
+                    with query_budgets(budgets):
+                        asyncio.run(benchmark.run(matches))
+                except QueryBudgetExceeded as error:
+                    budget_error = error
+                finally:
+                    connection_created.disconnect(benchmark.query_counter.install)
+                elapsed = time.perf_counter() - start
+                traced_peak = tracemalloc.get_traced_memory()[1] if options['tracemalloc'] else None
+                if options['tracemalloc']:
+                    tracemalloc.stop()
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            if test_database_file is not None and os.path.exists(test_database_file):
+                os.remove(test_database_file)
+        results = {
+            'options': {key: options[key] for key in ('matches', 'players', 'spectators', 'duration', 'move_delay', 'chat_interval', 'poll_interval', 'reconnect_interval', 'notification_sockets', 'resume', 'seed')},
+            'elapsed': elapsed,
+            'sockets': len(benchmark.sockets),
+            'messages_sent': benchmark.messages_sent,
+            'frames_received': benchmark.frames_received,
+            'busy_frames': benchmark.busy_frames,
+            'stale_frames': benchmark.stale_frames,
+            'invalid_frames': benchmark.invalid_frames,
+            'moves': benchmark.moves,
+            'moves_per_second': benchmark.moves / elapsed,
+            'queries': benchmark.query_counter.count,
+            'query_seconds': benchmark.query_counter.duration,
+            'queries_per_message': benchmark.query_counter.count / max(1, benchmark.messages_sent),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'traced_peak_bytes': traced_peak,
+            'timeouts': benchmark.timeouts,
+            'query_budget_error': str(budget_error) if budget_error else None,
+            'latencies': {},
+        }
+        for (kind, samples) in sorted(benchmark.latencies.items()):
+            samples = sorted(samples)
+            results['latencies'][kind] = {
+                'count': len(samples),
+                'p50_ms': 1000 * percentile(samples, 0.5),
+                'p99_ms': 1000 * percentile(samples, 0.99),
+                'max_ms': 1000 * samples[-1],
+            }
+        self.stdout.write(f'{results["sockets"]} sockets, {results["messages_sent"]} messages sent, {results["frames_received"]} frames received ({results["busy_frames"]} busy, {results["stale_frames"]} stale, {results["invalid_frames"]} invalid) in {elapsed:.1f}s')
+        self.stdout.write(f'{results["moves"]} moves ({results["moves_per_second"]:.2f}/s), {results["queries"]} queries ({results["queries_per_message"]:.1f}/message, {results["query_seconds"]:.2f}s)')
+        self.stdout.write(f'Peak RSS: {results["max_rss_kb"] / 1024:.1f} MiB' + (f', peak traced: {traced_peak / 1048576:.1f} MiB' if traced_peak is not None else ''))
+        for (kind, summary) in results['latencies'].items():
+            self.stdout.write(f'  {kind:16} n={summary["count"]:6}  p50={summary["p50_ms"]:8.1f}ms  p99={summary["p99_ms"]:8.1f}ms  max={summary["max_ms"]:8.1f}ms')
+        for (kind, count) in sorted(benchmark.timeouts.items()):
+            self.stdout.write(self.style.WARNING(f'  {kind}: {count} timeouts'))
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=1)
+        if budget_error:
+            raise CommandError(str(budget_error))
@@ -0,0 +1,119 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...replays import clean_replay, replay_match, play_random_match
+
+import json
+import random
+import statistics
+import time
+
+house_rules = ('resource_remainder_tiebreaker', 'card_draw_limits', 'weighted_card_draw', 'korea_nerf', 'lincoln_nerf')
+
+def parse_rule_set(rule_set):
+    rules = [rule for rule in rule_set.split(',') if rule]
+    for rule in rules:
+        if rule not in house_rules:
+            raise CommandError(f'Unknown house rule: {rule}')
+    return rules
+
+def build_corpus(player_counts, lengths, rule_sets, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for player_count in player_counts:
+        for rule_set in rule_sets:
+            rules = {'growth_resources': 2}
+            for rule in rule_set:
+                rules[rule] = True
+            for length in lengths:
+                player_names = [f'Player{i}' for i in range(1, player_count + 1)]
+                rules_name = 'all' if set(rule_set) == set(house_rules) else '+'.join(rule_set) or 'base'
+                (nations_match, moves) = play_random_match(player_names, rules, rng, max_moves=length if length else 10000)
+                corpus.append({
+                    'name': f'{player_count}p-{rules_name}-{length or "full"}',
+                    'player_count': player_count,
+                    'rules': rule_set,
+                    'moves': moves,
+                    'game_over': nations_match.get_state()['game_over'],
+                    'replay': clean_replay(nations_match.get_replay()),
+                })
+    return corpus
+
+def time_call(function, repeat):
+    samples = []
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    return (result, samples)
+
+def summarize(samples):
+    return {'min_ms': 1000 * min(samples), 'median_ms': 1000 * statistics.median(samples)}
+
+class Command(BaseCommand):
+    help = 'Time engine replays of a synthetic match corpus, building the corpus by playing random legal moves if needed.'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus', help='JSON file holding the synthetic corpus.')
+        parser.add_argument('--build', action='store_true', help='Build (or rebuild) the corpus before timing it.')
+        parser.add_argument('--players', default='2,3,4,5,6', help='Comma-separated player counts for the corpus.')
+        parser.add_argument('--lengths', default='50,200,0', help='Comma-separated move counts for the corpus (0 plays to the end of the game).')
+        parser.add_argument('--rule-set', action='append', dest='rule_sets', help='Comma-separated house rules for one corpus variant (repeatable, empty for none).')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5, help='Timed repetitions per corpus entry.')
+        parser.add_argument('--checkpoint-interval', type=int, default=50, help='Checkpoint interval used to estimate replay cost with checkpointing.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--compare', help='Results JSON from an earlier run to compare against.')
+
+    def handle(self, *args, **options):
+        if options['build']:
+            rule_sets = [parse_rule_set(rule_set) for rule_set in (options['rule_sets'] or ['', ','.join(house_rules)])]
+            player_counts = [int(player_count) for player_count in options['players'].split(',')]
+            lengths = [int(length) for length in options['lengths'].split(',')]
+            start = time.perf_counter()
+            corpus = build_corpus(player_counts, lengths, rule_sets, options['seed'])
+            with open(options['corpus'], 'w') as corpus_file:
+                json.dump(corpus, corpus_file, indent=1)
+            self.stdout.write(f'Built {len(corpus)} corpus matches in {time.perf_counter() - start:.1f}s.')
+        else:
+            try:
+                with open(options['corpus']) as corpus_file:
+                    corpus = json.load(corpus_file)
+            except (OSError, ValueError) as error:
+                raise CommandError(f'Could not read corpus {options["corpus"]}: {error}')
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as compare_file:
+                previous = {entry['name']: entry for entry in json.load(compare_file)['results']}
+        results = []
+        for entry in corpus:
+            (nations_match, replay_samples) = time_call(lambda: replay_match(entry['replay']), options['repeat'])
+            (state, state_samples) = time_call(nations_match.get_state, options['repeat'])
+            (log, log_samples) = time_call(nations_match.get_log, options['repeat'])
+            (replay, replay_text_samples) = time_call(nations_match.get_replay, options['repeat'])
+            result = {
+                'name': entry['name'],
+                'player_count': entry['player_count'],
+                'rules': entry['rules'],
+                'moves': entry['moves'],
+                'replay_bytes': len(entry['replay']),
+                'replay': summarize(replay_samples),
+                'get_state': summarize(state_samples),
+                'get_log': summarize(log_samples),
+                'get_replay': summarize(replay_text_samples),
+                'state_bytes': len(json.dumps(state)),
+                'log_bytes': len(log),
+            }
+            per_move_ms = result['replay']['median_ms'] / max(1, entry['moves'])
+            result['replay_ms_per_move'] = per_move_ms
+            result['checkpointed_replay_ms'] = per_move_ms * min(entry['moves'], options['checkpoint_interval'] / 2)
+            results.append(result)
+            line = f'{entry["name"]:40} {entry["moves"]:6} moves  replay {result["replay"]["median_ms"]:9.2f}ms  state {result["get_state"]["median_ms"]:7.2f}ms  log {result["get_log"]["median_ms"]:7.2f}ms  checkpointed {result["checkpointed_replay_ms"]:8.2f}ms'
+            if entry['name'] in previous:
+                before = previous[entry['name']]['replay']['median_ms']
+                line += f'  ({result["replay"]["median_ms"] / before if before else 0:.2f}x previous)'
+            self.stdout.write(line)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({'repeat': options['repeat'], 'checkpoint_interval': options['checkpoint_interval'], 'results': results}, output_file, indent=1)
@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from Nations.models import Match
+
+from ...replays import replay_match, state_fingerprint
+
+import json
+import multiprocessing
+import time
+import traceback
+
+def check_replay(match_id_and_replay):
+    (match_id, replay) = match_id_and_replay
+    start = time.perf_counter()
+    try:
+        fingerprint = state_fingerprint(replay_match(replay).get_state())
+        error = None
+    except Exception:
+        fingerprint = None
+        error = traceback.format_exc()
+    return (match_id, fingerprint, error, time.perf_counter() - start)
+
+class Command(BaseCommand):
+    help = 'Replay every stored match in parallel and compare the final states against a baseline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('baseline', help='JSON file of final state fingerprints, keyed by match ID.')
+        parser.add_argument('--write-baseline', action='store_true', help='Write the baseline instead of comparing against it.')
+        parser.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: CPU count).')
+        parser.add_argument('--slowest', type=int, default=10, help='Number of slowest replays to report.')
+
+    def handle(self, *args, **options):
+        if options['write_baseline']:
+            baseline = {}
+        else:
+            try:
+                with open(options['baseline']) as baseline_file:
+                    baseline = json.load(baseline_file)
+            except (OSError, ValueError) as error:
+                raise CommandError(f'Could not read baseline {options["baseline"]}: {error}')
+        replays = list(Match.objects.exclude(replay='').order_by('pk').values_list('match_id', 'replay'))
+        connections.close_all()
+        fingerprints = {}
+        crashed = []
+        diverged = []
+        timings = []
+        start = time.perf_counter()
+        with multiprocessing.Pool(options['processes']) as pool:
+            for (match_id, fingerprint, error, elapsed) in pool.imap_unordered(check_replay, replays, chunksize=8):
+                timings.append((elapsed, match_id))
+                if error is not None:
+                    crashed.append((match_id, error))
+                    continue
+                fingerprints[str(match_id)] = fingerprint
+                expected = baseline.get(str(match_id))
+                if not options['write_baseline'] and expected is not None and expected != fingerprint:
+                    diverged.append((match_id, expected, fingerprint))
+        total_elapsed = time.perf_counter() - start
+        timings.sort(reverse=True)
+        self.stdout.write(f'Replayed {len(replays)} matches in {total_elapsed:.1f}s ({sum(elapsed for (elapsed, match_id) in timings):.1f}s of engine time).')
+        for (elapsed, match_id) in timings[:options['slowest']]:
+            self.stdout.write(f'  match {match_id}: {elapsed:.3f}s')
+        for (match_id, error) in sorted(crashed):
+            self.stdout.write(self.style.ERROR(f'Match {match_id} crashed:'))
+            self.stdout.write(error)
+        for (match_id, expected, fingerprint) in sorted(diverged, key=lambda divergence: divergence[0]):
+            self.stdout.write(self.style.ERROR(f'Match {match_id} diverged:'))
+            self.stdout.write(f'  expected: {json.dumps(expected, sort_keys=True)}')
+            self.stdout.write(f'  actual:   {json.dumps(fingerprint, sort_keys=True)}')
+        if options['write_baseline']:
+            with open(options['baseline'], 'w') as baseline_file:
+                json.dump(fingerprints, baseline_file, indent=1, sort_keys=True)
+            self.stdout.write(f'Wrote {len(fingerprints)} fingerprints to {options["baseline"]}.')
+        else:
+            missing = len([match_id for match_id in fingerprints if match_id not in baseline])
+            if missing:
+                self.stdout.write(self.style.WARNING(f'{missing} matches are not in the baseline.'))
+        if crashed or diverged:
+            raise CommandError(f'{len(crashed)} matches crashed and {len(diverged)} matches diverged.')
+        self.stdout.write(self.style.SUCCESS('All replays match.'))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F, Prefetch
+
+from Nations.models import Match, MatchPlayer, MatchSnapshot
+from Nations.snapshots import build_match_snapshot
+
+import time
+
+class Command(BaseCommand):
+    help = 'Store frozen snapshots for completed matches that lack an up-to-date one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Rebuild every snapshot, not only missing or stale ones.')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        matches = Match.objects.filter(game_over=True).exclude(replay='')
+        if not options['rebuild']:
+            matches = matches.exclude(snapshot__version=F('version'))
+        match_ids = list(matches.order_by('match_id').values_list('match_id', flat=True))
+        start = time.perf_counter()
+        for i in range(0, len(match_ids), options['batch_size']):
+            batch = Match.objects.filter(match_id__in=match_ids[i:i + options['batch_size']]).prefetch_related(
+                Prefetch('players', MatchPlayer.objects.select_related('player').order_by('pk'), to_attr='ordered_players')
+            )
+            MatchSnapshot.objects.bulk_create([
+                MatchSnapshot(match=match, version=match.version, snapshot=build_match_snapshot(match, match.ordered_players))
+                for match in batch
+            ], update_conflicts=True, unique_fields=['match'], update_fields=['version', 'snapshot', 'created'])
+            self.stdout.write(f'Froze {min(i + options["batch_size"], len(match_ids))}/{len(match_ids)} matches ({time.perf_counter() - start:.1f}s).')
+        self.stdout.write(self.style.SUCCESS(f'Froze {len(match_ids)} completed matches.'))
@@ -0,0 +1,195 @@
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from users.models import User, get_deleted_user
+from Nations.models import Match, MatchPlayer, NationsChat, Tournament
+from Nations.standings import rebuild_standings
+
+from ...replays import clean_replay, play_random_match
+
+import datetime
+import random
+import re
+import time
+
+seat_pattern = re.compile(r'\bSEAT(\d)SEAT\b')
+
+def parse_weights(weights):
+    parsed = {}
+    for weight in weights.split(','):
+        (key, value) = weight.split(':')
+        parsed[int(key)] = float(value)
+    return parsed
+
+class PooledGame:
+    def __init__(self, nations_match, rules):
+        state = nations_match.get_state()
+        self.rules = rules
+        self.replay = clean_replay(nations_match.get_replay())
+        self.game_over = state['game_over']
+        self.round = state['round']
+        self.player_order = list(state['player_order'])
+        self.next_move_player = state['next_move_player']
+        self.players = {seat: (player_state['nation'], player_state['score'], player_state['resource_remainder']) for (seat, player_state) in state['players'].items()}
+
+    def seat(self, seat, names):
+        match = seat_pattern.fullmatch(seat or '')
+        return names[int(match.group(1)) - 1] if match else seat
+
+    def replay_for(self, names):
+        return seat_pattern.sub(lambda match: names[int(match.group(1)) - 1], self.replay)
+
+class Command(BaseCommand):
+    help = 'Bulk-generate a synthetic database of users, matches with real engine replays, chats and tournaments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--matches', type=int, default=20000)
+        parser.add_argument('--tournaments', type=int, default=20)
+        parser.add_argument('--tournament-matches', type=int, default=30, help='Matches assigned to each tournament.')
+        parser.add_argument('--player-counts', default='2:1,3:2,4:4,5:2,6:1', help='Weights for the number of players per match, as count:weight pairs.')
+        parser.add_argument('--open-fraction', type=float, default=0.05, help='Fraction of matches that are still waiting for players.')
+        parser.add_argument('--ongoing-fraction', type=float, default=0.25, help='Fraction of matches that are in progress.')
+        parser.add_argument('--chats', type=float, default=5.0, help='Mean chat messages per match.')
+        parser.add_argument('--days', type=int, default=365, help='Spread match creation over this many past days.')
+        parser.add_argument('--replay-pool', type=int, default=20, help='Engine games played per player count and status, reused with the players substituted (0 plays a fresh game for every match).')
+        parser.add_argument('--username-prefix', default='synthetic')
+        parser.add_argument('--password', help='Give every generated user this password (default: unusable passwords).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['open_fraction'] + options['ongoing_fraction'] > 1:
+            raise CommandError('The open and ongoing fractions add up to more than 1.')
+        if User.objects.filter(username__startswith=options['username_prefix']).exists():
+            raise CommandError(f'Users named {options["username_prefix"]}* already exist.')
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.pool = {}
+        start = time.perf_counter()
+        with transaction.atomic():
+            users = self.create_users()
+            self.stdout.write(f'Created {len(users)} users ({time.perf_counter() - start:.1f}s).')
+            matches = self.create_matches(users)
+            self.stdout.write(f'Created {len(matches)} matches ({time.perf_counter() - start:.1f}s).')
+            chat_count = self.create_chats(matches)
+            self.stdout.write(f'Created {chat_count} chats ({time.perf_counter() - start:.1f}s).')
+            tournaments = self.create_tournaments(users, matches)
+            self.stdout.write(f'Created {len(tournaments)} tournaments ({time.perf_counter() - start:.1f}s).')
+        self.stdout.write(self.style.SUCCESS(f'Done in {time.perf_counter() - start:.1f}s.'))
+
+    def create_users(self):
+        password = make_password(self.options['password']) if self.options['password'] else make_password(None)
+        prefix = self.options['username_prefix']
+        return User.objects.bulk_create([
+            User(username=f'{prefix}{i}', email=f'{prefix}{i}@games.tabony.net', password=password)
+            for i in range(self.options['users'])
+        ], batch_size=self.options['batch_size'])
+
+    def pooled_game(self, player_count, game_over):
+        key = (player_count, game_over)
+        games = self.pool.setdefault(key, [])
+        if self.options['replay_pool'] and len(games) >= self.options['replay_pool']:
+            return self.rng.choice(games)
+        seats = [f'SEAT{i}SEAT' for i in range(1, player_count + 1)]
+        rules = {'growth_resources': self.rng.choice((1, 2, 2, 3, 4))}
+        for house_rule in ('resource_remainder_tiebreaker', 'weighted_card_draw', 'korea_nerf', 'lincoln_nerf'):
+            if self.rng.random() < 0.7:
+                rules[house_rule] = True
+        while True:
+            max_moves = 10000 if game_over else self.rng.randint(1, 400)
+            game = PooledGame(play_random_match(seats, rules, self.rng, max_moves=max_moves)[0], rules)
+            self.pool.setdefault((player_count, game.game_over), []).append(game)
+            if game.game_over == game_over:
+                return game
+
+    def create_matches(self, users):
+        no_one = get_deleted_user()
+        usernames = {user.username: user for user in users}
+        player_counts = parse_weights(self.options['player_counts'])
+        now = timezone.now()
+        matches = []
+        created_times = []
+        match_players = []
+        for i in range(self.options['matches']):
+            player_count = self.rng.choices(list(player_counts), weights=list(player_counts.values()))[0]
+            status = self.rng.random()
+            created = now - datetime.timedelta(seconds=self.rng.uniform(0, self.options['days'] * 86400))
+            new_turn = created + (now - created) * self.rng.random()
+            players = self.rng.sample(users, player_count)
+            match = Match(title=f'Synthetic match {i}', player_count=player_count, current_player=no_one, new_turn=new_turn)
+            created_times.append(created)
+            if status < self.options['open_fraction']:
+                players = players[:self.rng.randint(1, player_count - 1)]
+                game = None
+            else:
+                game = self.pooled_game(player_count, status >= self.options['open_fraction'] + self.options['ongoing_fraction'])
+                names = [player.username for player in players]
+                match.growth_resources = game.rules['growth_resources']
+                for house_rule in ('resource_remainder_tiebreaker', 'weighted_card_draw', 'korea_nerf', 'lincoln_nerf'):
+                    setattr(match, house_rule, game.rules.get(house_rule, False))
+                match.replay = game.replay_for(names) + '\n'
+                match.game_over = game.game_over
+                match.current_round = game.round
+                match.current_player_order = ' '.join(game.seat(seat, names) for seat in game.player_order)
+                if not game.game_over:
+                    match.current_player = usernames.get(game.seat(game.next_move_player, names), no_one)
+            matches.append(match)
+            for (seat, player) in enumerate(players, 1):
+                match_player = MatchPlayer(match=match, player=player, growth_resources=match.growth_resources, accepted=True)
+                if game is not None:
+                    (match_player.nation, match_player.score, match_player.resource_remainder) = game.players.get(f'SEAT{seat}SEAT', ('', 0, 0))
+                match_players.append(match_player)
+        Match.objects.bulk_create(matches, batch_size=self.options['batch_size'])
+        for (match, created) in zip(matches, created_times):
+            match.created = created
+        Match.objects.bulk_update(matches, ['created'], batch_size=self.options['batch_size'])
+        MatchPlayer.objects.bulk_create(match_players, batch_size=self.options['batch_size'])
+        self.match_players = match_players
+        return matches
+
+    def create_chats(self, matches):
+        players_by_match = {}
+        for match_player in self.match_players:
+            players_by_match.setdefault(match_player.match_id, []).append(match_player)
+        chats = []
+        created_times = []
+        for match in matches:
+            match_players = players_by_match.get(match.match_id, [])
+            if not match_players:
+                continue
+            for i in range(int(self.rng.expovariate(1 / self.options['chats'])) if self.options['chats'] > 0 else 0):
+                chats.append(NationsChat(match=match, player=self.rng.choice(match_players).player, message=f'Synthetic chat {self.rng.getrandbits(32):08x}'))
+                created_times.append(match.created + (match.new_turn - match.created) * self.rng.random())
+        NationsChat.objects.bulk_create(chats, batch_size=self.options['batch_size'])
+        for (chat, created) in zip(chats, created_times):
+            chat.created = created
+        NationsChat.objects.bulk_update(chats, ['created'], batch_size=self.options['batch_size'])
+        last_chats = {}
+        for chat in chats:
+            last_chats[chat.match_id] = max(last_chats.get(chat.match_id, 0), chat.pk)
+        for match_player in self.match_players:
+            if match_player.match_id in last_chats and self.rng.random() < 0.8:
+                match_player.last_chat = last_chats[match_player.match_id]
+        MatchPlayer.objects.bulk_update(self.match_players, ['last_chat'], batch_size=self.options['batch_size'])
+        return len(chats)
+
+    def create_tournaments(self, users, matches):
+        tournaments = Tournament.objects.bulk_create([
+            Tournament(title=f'Synthetic tournament {i}', organizer=self.rng.choice(users))
+            for i in range(self.options['tournaments'])
+        ])
+        candidates = [match for match in matches if match.replay]
+        self.rng.shuffle(candidates)
+        assigned = []
+        for tournament in tournaments:
+            for match in candidates[:self.options['tournament_matches']]:
+                match.tournament = tournament
+                assigned.append(match)
+            candidates = candidates[self.options['tournament_matches']:]
+        Match.objects.bulk_update(assigned, ['tournament'], batch_size=self.options['batch_size'])
+        for tournament in tournaments:
+            rebuild_standings(tournament)
+        return tournaments
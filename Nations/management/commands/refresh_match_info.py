@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 
-from Nations.models import Match, MatchPlayer
+from Nations.models import Match, MatchPlayer, Tournament
+from Nations.standings import rebuild_standings
 
 from ... import nations
 
@@ -38,3 +39,5 @@ class Command(BaseCommand):
                     player.score = player_state['score']
                     player.resource_remainder = player_state['resource_remainder']
                     player.save()
+        for tournament in Tournament.objects.order_by('pk'):
+            rebuild_standings(tournament)
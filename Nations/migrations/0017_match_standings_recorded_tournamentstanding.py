@@ -0,0 +1,37 @@
+# Generated by Django 5.1.6 on 2026-10-19 11:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Nations', '0016_alter_match_tournament'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='standings_recorded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='TournamentStanding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('matches_played', models.IntegerField(default=0)),
+                ('wins', models.IntegerField(default=0)),
+                ('points', models.IntegerField(default=0)),
+                ('score', models.IntegerField(default=0)),
+                ('resource_remainder', models.IntegerField(default=0)),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('tournament', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='standings', to='Nations.tournament')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('tournament', 'player'), name='unique_tournament_standing')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-19 11:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Nations', '0017_match_standings_recorded_tournamentstanding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
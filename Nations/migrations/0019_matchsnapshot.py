@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-19 11:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Nations', '0018_match_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchSnapshot',
+            fields=[
+                ('match', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='Nations.match')),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('snapshot', models.JSONField(default=dict)),
+                ('created', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.6 on 2026-10-19 11:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Nations', '0019_matchsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EngineLease',
+            fields=[
+                ('match', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='engine_lease', serialize=False, to='Nations.match')),
+                ('owner', models.CharField(max_length=200)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+    ]
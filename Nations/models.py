@@ -29,6 +29,8 @@ class Match(models.Model):
     current_round = models.IntegerField(default=0)
     game_over = models.BooleanField(default=False)
     tournament = models.ForeignKey(Tournament, null=True, blank=True, on_delete=models.SET_NULL, related_name='matches')
+    standings_recorded = models.BooleanField(default=False)
+    version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f'Nations match {self.match_id}'
@@ -56,6 +58,40 @@ class NationsChat(models.Model):
     def __str__(self):
         return f'{self.match}: {self.player.username}: {self.message}'
 
+class TournamentStanding(models.Model):
+    tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='standings')
+    player = models.ForeignKey(User, on_delete=models.CASCADE)
+    matches_played = models.IntegerField(default=0)
+    wins = models.IntegerField(default=0)
+    points = models.IntegerField(default=0)
+    score = models.IntegerField(default=0)
+    resource_remainder = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('tournament', 'player'), name='unique_tournament_standing'),
+        ]
+
+    def __str__(self):
+        return f'{self.tournament}: {self.player.username}, {self.wins} wins, {self.points} points'
+
+class MatchSnapshot(models.Model):
+    match = models.OneToOneField(Match, primary_key=True, on_delete=models.CASCADE, related_name='snapshot')
+    version = models.PositiveIntegerField(default=0)
+    snapshot = models.JSONField(default=dict)
+    created = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.match} snapshot at version {self.version}'
+
+class EngineLease(models.Model):
+    match = models.OneToOneField(Match, primary_key=True, on_delete=models.CASCADE, related_name='engine_lease')
+    owner = models.CharField(max_length=200)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.match} engine owned by {self.owner} until {self.expires}'
+
 color_choices = ('Pink', 'Blue', 'Yellow', 'Orange', 'Green', 'Cyan', 'Red', 'Purple')
 
 class NationsPreferences(models.Model):
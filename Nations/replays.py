@@ -0,0 +1,50 @@
+from . import nations
+
+class TerminatePlay(Exception):
+    pass
+
+def clean_replay(replay):
+    return replay.replace('\r', '').rstrip('\n')
+
+def stop_at_next_choice(choice, options, undo):
+    raise TerminatePlay()
+
+def replay_match(replay):
+    nations_match = nations.Match(move_getter=stop_at_next_choice, replay=clean_replay(replay))
+    try:
+        nations_match.play()
+    except TerminatePlay:
+        pass
+    return nations_match
+
+def state_fingerprint(state):
+    return {
+        'round': state['round'],
+        'player_order': list(state['player_order']),
+        'game_over': state['game_over'],
+        'players': {
+            player: {
+                'nation': player_state['nation'],
+                'score': player_state['score'],
+                'resource_remainder': player_state['resource_remainder'],
+            }
+            for (player, player_state) in sorted(state['players'].items())
+        },
+    }
+
+def play_random_match(player_names, rules, rng, max_moves=10000):
+    moves = 0
+
+    def random_move_getter(choice, options, undo):
+        nonlocal moves
+        if moves >= max_moves or not options:
+            raise TerminatePlay()
+        moves += 1
+        return rng.choice([option for option in options if str(option) not in ('UNDO', 'Resign')] or options)
+
+    nations_match = nations.Match(player_names=player_names, move_getter=random_move_getter, rules=rules)
+    try:
+        nations_match.play()
+    except TerminatePlay:
+        pass
+    return (nations_match, moves)
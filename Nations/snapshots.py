@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import MatchSnapshot
+from .replays import clean_replay, replay_match
+
+import zlib
+
+def get_notes_revision(notes):
+    return zlib.crc32(notes.encode())
+
+def chat_entry(chat):
+    return {'id': chat.pk, 'timestamp': chat.created.isoformat(), 'player': chat.player.username, 'message': chat.message}
+
+def snapshot_cache_key(match_id):
+    return f'nations_match_snapshot_{match_id}'
+
+def cache_match_snapshot(match_id, snapshot):
+    cache.set(snapshot_cache_key(match_id), snapshot, settings.MATCH_SNAPSHOT_CACHE_TIMEOUT)
+
+async def acache_match_snapshot(match_id, snapshot):
+    await cache.aset(snapshot_cache_key(match_id), snapshot, settings.MATCH_SNAPSHOT_CACHE_TIMEOUT)
+
+def get_cached_match_snapshot(match_id, version):
+    snapshot = cache.get(snapshot_cache_key(match_id))
+    if snapshot is None or snapshot['version'] != version:
+        return None
+    return snapshot
+
+async def aget_cached_match_snapshot(match_id, version):
+    snapshot = await cache.aget(snapshot_cache_key(match_id))
+    if snapshot is None or snapshot['version'] != version:
+        return None
+    return snapshot
+
+def match_etag(match_id, version):
+    return f'{match_id}-{version}'
+
+def build_match_snapshot(match, match_players=None):
+    if match_players is None:
+        match_players = list(match.players.select_related('player').order_by('pk'))
+    state = None
+    log = ''
+    if match.replay:
+        nations_match = replay_match(match.replay)
+        state = nations_match.get_state()
+        log = clean_replay(nations_match.get_log())
+    return match_snapshot(match, match_players, state, log)
+
+def match_snapshot(match, match_players, state, log):
+    players = [match_player.player.username for match_player in match_players][:match.player_count]
+    return {
+        'players': players,
+        'accepted': [match_player.player.username for match_player in match_players if match_player.accepted],
+        'growth_resources': {match_player.player.username: match_player.growth_resources for match_player in match_players if match_player.player.username in players},
+        'state': state,
+        'log': log,
+        'version': match.version,
+    }
+
+def get_stored_match_snapshot(match):
+    return MatchSnapshot.objects.filter(match=match, version=match.version).values_list('snapshot', flat=True).first()
+
+def store_match_snapshot(match_id, snapshot):
+    MatchSnapshot.objects.update_or_create(match_id=match_id, defaults={'version': snapshot['version'], 'snapshot': snapshot})
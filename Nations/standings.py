@@ -0,0 +1,55 @@
+from django.db import transaction
+from django.db.models import F
+
+from .models import Match, TournamentStanding
+
+def match_results(match, match_players):
+    if match.resource_remainder_tiebreaker:
+        ranks = {match_player.pk: (match_player.score, match_player.resource_remainder) for match_player in match_players}
+    else:
+        ranks = {match_player.pk: (match_player.score,) for match_player in match_players}
+    if not ranks:
+        return []
+    best_rank = max(ranks.values())
+    results = []
+    for match_player in match_players:
+        rank = ranks[match_player.pk]
+        won = rank == best_rank
+        points = len([other_rank for other_rank in ranks.values() if other_rank < rank])
+        results.append((match_player, won, points))
+    return results
+
+def record_match_result(match_id):
+    with transaction.atomic():
+        if not Match.objects.filter(match_id=match_id, game_over=True, tournament__isnull=False, standings_recorded=False).update(standings_recorded=True):
+            return
+        match = Match.objects.defer('replay').get(match_id=match_id)
+        for (match_player, won, points) in match_results(match, list(match.players.all())):
+            TournamentStanding.objects.get_or_create(tournament_id=match.tournament_id, player_id=match_player.player_id)
+            TournamentStanding.objects.filter(tournament_id=match.tournament_id, player_id=match_player.player_id).update(
+                matches_played=F('matches_played') + 1,
+                wins=F('wins') + int(won),
+                points=F('points') + points,
+                score=F('score') + match_player.score,
+                resource_remainder=F('resource_remainder') + match_player.resource_remainder
+            )
+
+def rebuild_standings(tournament):
+    with transaction.atomic():
+        standings = {}
+        for match in tournament.matches.filter(game_over=True).defer('replay').prefetch_related('players'):
+            for (match_player, won, points) in match_results(match, list(match.players.all())):
+                if match_player.player_id not in standings:
+                    standings[match_player.player_id] = TournamentStanding(tournament=tournament, player_id=match_player.player_id)
+                standing = standings[match_player.player_id]
+                standing.matches_played += 1
+                standing.wins += int(won)
+                standing.points += points
+                standing.score += match_player.score
+                standing.resource_remainder += match_player.resource_remainder
+        tournament.standings.all().delete()
+        TournamentStanding.objects.bulk_create(standings.values())
+        tournament.matches.update(standings_recorded=F('game_over'))
+
+def ordered_standings(tournament):
+    return tournament.standings.select_related('player').order_by('-wins', '-points', '-score', '-resource_remainder', 'player__username')
@@ -0,0 +1,252 @@
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from unittest import mock
+
+from users.models import User
+from Games import routing
+from Games.metrics import query_budgets
+from .consumers import NationsMatchConsumer
+from .engines import ThreadState, is_quarantined, quarantined_matches
+from .history import build_lock, build_locks
+from .leases import LocalEngineLeases
+from .models import Match, MatchPlayer
+from .writebehind import WriteBehindBuffer
+
+import threading
+import time
+
+class LocalEngineLeasesTests(SimpleTestCase):
+    def setUp(self):
+        self.leases = LocalEngineLeases()
+
+    def test_acquire(self):
+        self.assertEqual(self.leases.acquire(1, 'a', 60), 'a')
+        self.assertEqual(self.leases.acquire(1, 'b', 60), 'a')
+        self.assertEqual(self.leases.acquire(2, 'b', 60), 'b')
+
+    def test_renew(self):
+        self.leases.acquire(1, 'a', 60)
+        self.assertEqual(self.leases.acquire(1, 'a', 60), 'a')
+        self.assertEqual(self.leases.acquire(1, 'b', 60), 'a')
+
+    def test_expire(self):
+        self.leases.acquire(1, 'a', -1)
+        self.assertEqual(self.leases.acquire(1, 'b', 60), 'b')
+        self.assertEqual(self.leases.acquire(1, 'a', 60), 'b')
+
+    def test_release(self):
+        self.leases.acquire(1, 'a', 60)
+        self.leases.release(1, 'b')
+        self.assertEqual(self.leases.acquire(1, 'b', 60), 'a')
+        self.leases.release(1, 'a')
+        self.assertEqual(self.leases.acquire(1, 'b', 60), 'b')
+
+def match_communicator(match, user):
+    communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), f'/ws/nations/{match.pk}/')
+    communicator.scope['user'] = user
+    return communicator
+
+async def receive_until(communicator, key):
+    while True:
+        frame = await communicator.receive_json_from(timeout=5)
+        if isinstance(frame, dict) and key in frame:
+            return frame
+
+class MatchConsumerTestCase(TestCase):
+    def setUp(self):
+        self.engine_leases = LocalEngineLeases()
+        patcher = mock.patch('Nations.consumers.engine_leases', self.engine_leases)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.users = [User.objects.create_user(username=username, password='password') for username in ('alice', 'bob')]
+        self.match = Match.objects.create(player_count=2)
+        for user in self.users:
+            MatchPlayer.objects.create(match=self.match, player=user)
+
+    async def start_match(self):
+        owner = match_communicator(self.match, self.users[0])
+        await owner.connect()
+        await owner.send_json_to(None)
+        state = (await receive_until(owner, 'state'))['state']
+        await owner.disconnect()
+        return state
+
+    def lease_owner(self):
+        return self.engine_leases.acquire(self.match.pk, 'nobody', 60)
+
+@override_settings(ENGINE_FORWARD_TIMEOUT=0.2)
+class EngineForwardTests(MatchConsumerTestCase):
+    async def start_match(self):
+        state = await super().start_match()
+        self.ghost = await get_channel_layer().new_channel()
+        self.engine_leases.acquire(self.match.pk, self.ghost, 60)
+        return state
+
+    def expire_ghost(self):
+        self.engine_leases.leases[self.match.pk] = (self.ghost, time.monotonic() - 1)
+
+    async def test_follower_waits_for_busy_owner(self):
+        await self.start_match()
+        cache.clear()
+        follower = match_communicator(self.match, self.users[1])
+        await follower.connect()
+        try:
+            await follower.send_json_to(None)
+            await receive_until(follower, 'busy')
+            self.assertEqual(self.lease_owner(), self.ghost)
+            self.expire_ghost()
+            await follower.send_json_to(None)
+            frame = await receive_until(follower, 'state')
+            self.assertIsNotNone(frame['state'])
+            self.assertNotIn(self.lease_owner(), (self.ghost, 'nobody'))
+        finally:
+            await follower.disconnect()
+
+    async def test_move_forward_takes_over_expired_lease_only(self):
+        state = await self.start_match()
+        user = next(user for user in self.users if user.username == state['next_move_player'])
+        move = next(str(option) for option in state['next_move_options'] if str(option) not in ('UNDO', 'Resign'))
+        follower = match_communicator(self.match, user)
+        await follower.connect()
+        try:
+            await follower.send_json_to(None)
+            version = (await receive_until(follower, 'state'))['version']
+            await follower.send_json_to({'move': move, 'version': version})
+            await receive_until(follower, 'busy')
+            self.assertEqual(self.lease_owner(), self.ghost)
+            self.assertEqual((await Match.objects.aget(pk=self.match.pk)).version, version)
+            self.expire_ghost()
+            await follower.send_json_to({'move': move, 'version': version})
+            frame = await receive_until(follower, 'state')
+            self.assertEqual(frame['version'], version + 1)
+            self.assertNotIn(self.lease_owner(), (self.ghost, 'nobody'))
+        finally:
+            await follower.disconnect()
+
+    async def test_stale_move_is_rejected_before_engine_work(self):
+        state = await self.start_match()
+        user = next(user for user in self.users if user.username == state['next_move_player'])
+        version = (await Match.objects.aget(pk=self.match.pk)).version
+        follower = match_communicator(self.match, user)
+        await follower.connect()
+        try:
+            with mock.patch.object(NationsMatchConsumer, 'get_match_info') as get_match_info:
+                for stale_version in (version - 1, version + 1):
+                    await follower.send_json_to({'move': 'Pass', 'version': stale_version})
+                    frame = await receive_until(follower, 'stale_move')
+                    self.assertEqual(frame['stale_move']['version'], version)
+                get_match_info.assert_not_awaited()
+        finally:
+            await follower.disconnect()
+
+class EngineTimeoutTests(MatchConsumerTestCase):
+    def tearDown(self):
+        quarantined_matches.clear()
+
+    async def engine_error_after(self, budget):
+        await self.start_match()
+        communicator = match_communicator(self.match, self.users[1])
+        await communicator.connect()
+        try:
+            with mock.patch.object(ThreadState, 'wait_for_state', autospec=True, side_effect=lambda thread_state: thread_state.abandon(budget)):
+                await communicator.send_json_to(None)
+                frame = await receive_until(communicator, 'engine_error')
+            self.assertEqual(self.lease_owner(), 'nobody')
+            return frame['engine_error']['retry_after']
+        finally:
+            await communicator.disconnect()
+
+    async def test_quarantined_engine_releases_lease(self):
+        retry_after = await self.engine_error_after('wall')
+        self.assertGreater(retry_after, 1000 * (settings.ENGINE_QUARANTINE_TIMEOUT - 10))
+        self.assertLessEqual(retry_after, 1000 * settings.ENGINE_QUARANTINE_TIMEOUT)
+
+    async def test_stopped_engine_retries_soon(self):
+        self.assertEqual(await self.engine_error_after('stopped'), settings.ENGINE_RETRY_AFTER)
+
+class QuarantineTests(SimpleTestCase):
+    def tearDown(self):
+        quarantined_matches.clear()
+
+    def test_expired_quarantines_are_dropped(self):
+        quarantined_matches.update({1: time.monotonic() - 1, 2: time.monotonic() + 60})
+        self.assertFalse(is_quarantined(1))
+        self.assertTrue(is_quarantined(2))
+        self.assertEqual(list(quarantined_matches), [2])
+
+class WriteBehindTests(TestCase):
+    def test_flush_never_lowers_stored_chat_markers(self):
+        match = Match.objects.create(player_count=2)
+        (ahead, behind) = [MatchPlayer.objects.create(match=match, player=User.objects.create_user(username=username, password='password'), last_chat=last_chat) for (username, last_chat) in (('alice', 10), ('bob', 0))]
+        buffer = WriteBehindBuffer()
+        buffer.set_last_chat(ahead.pk, 5)
+        buffer.set_last_chat(behind.pk, 7)
+        buffer.flush()
+        self.assertEqual(list(MatchPlayer.objects.filter(match=match).order_by('pk').values_list('last_chat', flat=True)), [10, 7])
+
+class HistoryBuildLockTests(SimpleTestCase):
+    def test_lock_is_kept_until_the_last_waiter_leaves(self):
+        key = (1, 0)
+        holding = threading.Event()
+        def build(leave):
+            with build_lock(key):
+                holding.set()
+                leave.wait()
+        (holder_leave, waiter_leave) = (threading.Event(), threading.Event())
+        holder = threading.Thread(target=build, args=(holder_leave,))
+        holder.start()
+        holding.wait()
+        holding.clear()
+        waiter = threading.Thread(target=build, args=(waiter_leave,))
+        waiter.start()
+        while build_locks[key][1] < 2:
+            time.sleep(0.01)
+        lock = build_locks[key][0]
+        holder_leave.set()
+        holder.join()
+        holding.wait()
+        self.assertIs(build_locks[key][0], lock)
+        waiter_leave.set()
+        waiter.join()
+        self.assertNotIn(key, build_locks)
+
+match_consumer_query_budgets = {
+    'nations_match.info': 16,
+    'nations_match.join': 51,
+    'nations_match.state_change_message': 9,
+    'nations_match.chat': 2,
+    'nations_match.chat_message': 1,
+}
+
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=username, password='password') for username in ('alice', 'bob')]
+        self.match = Match.objects.create(player_count=2)
+        MatchPlayer.objects.create(match=self.match, player=self.users[0])
+
+    async def test_match_consumer_budgets(self):
+        alice = match_communicator(self.match, self.users[0])
+        bob = match_communicator(self.match, self.users[1])
+        await alice.connect()
+        await bob.connect()
+        try:
+            with query_budgets(match_consumer_query_budgets):
+                await alice.send_json_to(None)
+                await receive_until(alice, 'players')
+                await bob.send_json_to({'join': 2})
+                await receive_until(bob, 'players')
+                await receive_until(alice, 'players')
+                await alice.send_json_to({'chat': 'Hello'})
+                await receive_until(alice, 'chat')
+                await receive_until(bob, 'chat')
+                for communicator in (alice, bob):
+                    await communicator.send_json_to({'keepalive': None})
+                    await receive_until(communicator, 'keepalive')
+        finally:
+            await alice.disconnect()
+            await bob.disconnect()
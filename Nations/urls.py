@@ -17,11 +17,15 @@ urlpatterns = [
     path('archive/completed/', views.archive_completed, name='archive_completed'),
     path('archive/mine/', views.archive_mine, name='archive_mine'),
     path('<int:pk>/', views.match, name='match'),
+    path('<int:pk>/state/', views.match_state, name='match_state'),
+    path('<int:pk>/history/<int:move>/', views.match_history, name='match_history'),
     path('tournaments/', views.tournaments, name='tournaments'),
     path('tournaments/create/', views.create_tournament, name='create_tournament'),
     path('tournaments/<int:pk>/', views.tournament, name='tournament'),
     path('tournaments/<int:pk>/manage/', views.manage_tournament, name='manage_tournament'),
+    path('tournaments/<int:pk>/round/', views.create_tournament_round, name='create_tournament_round'),
     path('tournaments/<int:pk>/csv/', views.tournament_csv, name='tournament_csv'),
+    path('matches/csv/', views.matches_csv, name='matches_csv'),
     path('stats/', views.stats, name='stats'),
     path('stats/replays/', views.completed_matches_replays, name='completed_matches_replays'),
 ]
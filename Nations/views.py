@@ -2,12 +2,22 @@ from django.conf import settings
 from django.shortcuts import get_object_or_404, render, redirect
 from django.contrib.auth.decorators import login_required
 from django.utils.timezone import make_aware
-from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition, require_safe
+from django.db import transaction
+from django.db.models import Prefetch
 
-from users.models import User, get_deleted_user
+from users.models import User, get_deleted_user, is_superuser
 from .models import Match, MatchPlayer, Tournament, NationsPreferences, NationsChat
-from .forms import CreateMatchForm, CreateTournamentForm, ManageTournamentForm
+from .forms import CreateMatchForm, CreateTournamentForm, ManageTournamentForm, CreateTournamentRoundForm
+from .standings import rebuild_standings, ordered_standings
+from .history import HistoryUnavailable, get_historical_state
+from .admission import EngineBuilds, EngineBusy
+from .snapshots import build_match_snapshot, cache_match_snapshot, chat_entry, get_cached_match_snapshot, get_stored_match_snapshot, get_notes_revision, match_etag
+from .writebehind import write_behind
+from .lobby import MatchProperties, publish_match_cards
 
 from . import nations
 
@@ -16,6 +26,16 @@ import datetime
 import csv
 import tarfile
 import io
+import math
+import random
+
+engine_builds = EngineBuilds(settings.ENGINE_HTTP_BUILD_CONCURRENCY)
+
+def engine_busy_response():
+    response = HttpResponse('The game engine is busy, try again shortly.', status=503, content_type='text/plain')
+    response['Retry-After'] = str(math.ceil(settings.ENGINE_RETRY_AFTER / 1000))
+    patch_cache_control(response, no_store=True)
+    return response
 
 def number_of_turns(user):
     if not user.is_authenticated:
@@ -73,6 +93,7 @@ def confirm_create_match(request):
             match_player = MatchPlayer.objects.create(match=match, player=player, growth_resources=data['growth_resources'], accepted=accepted)
             match_player.save()
         match.save()
+        publish_match_cards([match.match_id], 'created')
         return redirect('Nations:match', pk=match.match_id)
     return render(request, 'Nations/confirm_create.html', {
         'IN_PRODUCTION': settings.IN_PRODUCTION,
@@ -80,65 +101,6 @@ def confirm_create_match(request):
         'data': data
     })
 
-class MatchProperties:
-    growth_resources_descriptions = {
-        1: 'Emperor',
-        2: 'King',
-        3: 'Prince',
-        4: 'Chieftain',
-        -1: 'Variable Growth Resources'
-    }
-
-    def __init__(self, match, match_player=None):
-        self._match_id = match.match_id
-        self.title = match.title
-        self.player_count = match.player_count
-        self.growth_resources = match.growth_resources
-        self.match_type = f'{self.player_count}-Player, {self.growth_resources_descriptions[self.growth_resources]}'
-        house_rules = []
-        if match.extra_draft_nations != 0:
-            if match.extra_draft_nations < 0:
-                house_rules.append('Draft-from-All')
-            else:
-                house_rules.append(f'+{match.extra_draft_nations} Draft')
-        if match.resource_remainder_tiebreaker:
-            house_rules.append('Tiebreaker')
-        if match.card_draw_limits:
-            house_rules.append('Card Draw Limits')
-        if match.weighted_card_draw:
-            house_rules.append('Card Draw')
-        if match.korea_nerf:
-            house_rules.append('Korea Nerf')
-        if match.lincoln_nerf:
-            house_rules.append('Lincoln Nerf')
-        self.house_rules = ', '.join(house_rules)
-        players = match.players.order_by('pk')
-        self.players = [player.player.username for player in players]
-        self.current_player = match.current_player.username if match.replay.strip() and not match.game_over else None
-        self.invited = [player.player.username for player in players if not player.accepted]
-        self.full = len(players) == match.player_count
-        self.game_over = match.game_over
-        self._new_turn = match.new_turn
-        self.new_turn_iso = match.new_turn.isoformat()
-        self.last_chat_seen = True
-        if match_player is not None:
-            try:
-                last_chat = match.chats.latest('pk')
-            except ObjectDoesNotExist:
-                last_chat = None
-            if last_chat is not None:
-                last_chat_id = last_chat.pk
-                self.last_chat_seen = last_chat_id <= match_player.last_chat
-
-    def get_match_id(self):
-        return self._match_id
-
-    def get_new_turn(self):
-        return self._new_turn
-
-    match_id = property(get_match_id)
-    new_turn = property(get_new_turn)
-
 def open_matches(request):
     user = request.user
     if user.is_authenticated:
@@ -146,6 +108,7 @@ def open_matches(request):
     else:
         username = ''
     no_one = get_deleted_user()
+    lobby_since = make_aware(datetime.datetime.now())
     archive_threshold = make_aware(datetime.datetime.now() - datetime.timedelta(days=7))
     matches = [MatchProperties(match) for match in Match.objects.filter(game_over=False, current_player=no_one, new_turn__gte=archive_threshold).order_by('match_id')]
     invited_matches = []
@@ -169,7 +132,9 @@ def open_matches(request):
         'invited_matches': invited_matches,
         'open_matches': open_matches,
         'joined_matches': joined_matches,
-        'full_matches': full_matches
+        'full_matches': full_matches,
+        'lobby_feed': 'open',
+        'lobby_since': lobby_since.isoformat()
     })
 
 def matches(request):
@@ -197,6 +162,7 @@ def completed_matches(request):
 @login_required
 def my_matches(request):
     username = request.user.username
+    lobby_since = make_aware(datetime.datetime.now())
     archive_threshold = make_aware(datetime.datetime.now() - datetime.timedelta(days=7))
     matches = [MatchProperties(match_player.match, match_player) for match_player in MatchPlayer.objects.filter(player=request.user, match__new_turn__gte=archive_threshold)]
     invited_matches = []
@@ -227,7 +193,9 @@ def my_matches(request):
         'my_turn_matches': my_turn_matches,
         'open_matches': open_matches,
         'other_matches': other_matches,
-        'completed_matches': completed_matches
+        'completed_matches': completed_matches,
+        'lobby_feed': 'mine',
+        'lobby_since': lobby_since.isoformat()
     })
 
 def archive(request):
@@ -326,6 +294,22 @@ def archive_mine(request):
         'completed_matches': completed_matches
     })
 
+def initial_match_data(match, user):
+    snapshot = get_cached_match_snapshot(match.match_id, match.version) or get_stored_match_snapshot(match)
+    if snapshot is None:
+        return None
+    chats = list(match.chats.select_related('player').order_by('pk'))
+    match_player = match.players.filter(player=user).first() if user.is_authenticated else None
+    if match_player is not None and chats and write_behind.last_chat(match_player) < chats[-1].pk:
+        write_behind.set_last_chat(match_player.pk, chats[-1].pk)
+    notes = match_player.notes if match_player is not None else ''
+    return {
+        'match': snapshot,
+        'chat_log': [chat_entry(chat) for chat in chats],
+        'notes': notes,
+        'notes_revision': get_notes_revision(notes),
+    }
+
 def match(request, pk):
     match = get_object_or_404(Match, match_id=pk)
     match_properties = MatchProperties(match)
@@ -342,9 +326,59 @@ def match(request, pk):
         'turns': number_of_turns(request.user),
         'match': match_properties,
         'player_preferences': preferences,
+        'initial_match_data': initial_match_data(match, user),
         'abbrs': nations.abbr.abbrs
     })
 
+def match_state_etag(request, pk):
+    version = Match.objects.filter(match_id=pk).values_list('version', flat=True).first()
+    if version is None:
+        return None
+    return match_etag(pk, version)
+
+@require_safe
+@condition(etag_func=match_state_etag)
+def match_state(request, pk):
+    match = get_object_or_404(Match, match_id=pk)
+    snapshot = get_cached_match_snapshot(match.match_id, match.version) or get_stored_match_snapshot(match)
+    if snapshot is None:
+        try:
+            with engine_builds.admit():
+                snapshot = build_match_snapshot(match)
+        except EngineBusy:
+            return engine_busy_response()
+        cache_match_snapshot(match.match_id, snapshot)
+    response = JsonResponse(snapshot)
+    response['ETag'] = quote_etag(match_etag(match.match_id, match.version))
+    patch_cache_control(response, public=True, max_age=settings.COMPLETED_MATCH_STATE_MAX_AGE if match.game_over else settings.MATCH_STATE_MAX_AGE)
+    return response
+
+def match_history_etag(request, pk, move):
+    version = Match.objects.filter(match_id=pk).values_list('version', flat=True).first()
+    if version is None:
+        return None
+    return f'{match_etag(pk, version)}-{move}'
+
+@require_safe
+@condition(etag_func=match_history_etag)
+def match_history(request, pk, move):
+    match = get_object_or_404(Match, match_id=pk)
+    if not match.replay:
+        raise Http404('The match has not started.')
+    match_players = list(match.players.select_related('player').order_by('pk'))
+    try:
+        (state, moves) = get_historical_state(match, match_players, move, engine_builds.admit)
+    except HistoryUnavailable as error:
+        raise Http404(str(error))
+    except EngineBusy:
+        return engine_busy_response()
+    if state is None:
+        raise Http404(f'The match only has {moves} moves.')
+    response = JsonResponse({'move': move, 'moves': moves, 'version': match.version, 'state': state})
+    response['ETag'] = quote_etag(f'{match_etag(match.match_id, match.version)}-{move}')
+    patch_cache_control(response, public=True, max_age=settings.COMPLETED_MATCH_STATE_MAX_AGE if match.game_over else settings.MATCH_STATE_MAX_AGE)
+    return response
+
 def tournaments(request):
     tournaments = Tournament.objects.order_by('pk')
     return render(request, 'Nations/tournaments.html', {
@@ -360,6 +394,7 @@ def tournament(request, pk):
         'IN_PRODUCTION': settings.IN_PRODUCTION,
         'turns': number_of_turns(request.user),
         'tournament': tournament,
+        'standings': ordered_standings(tournament),
         'matches': matches
     })
 
@@ -388,16 +423,12 @@ def manage_tournament(request, pk):
     if request.method == 'POST' and authorized:
         form = ManageTournamentForm(request.POST, instance=tournament)
         if form.is_valid():
-            tournament.title = form.cleaned_data.get('title')
-            tournament.save()
-            for match_id in form.cleaned_data.get('add_matches'):
-                match = Match.objects.get(match_id=match_id)
-                match.tournament = tournament
-                match.save()
-            for match_id in form.cleaned_data.get('remove_matches'):
-                match = Match.objects.get(match_id=match_id)
-                match.tournament = None
-                match.save()
+            with transaction.atomic():
+                tournament.title = form.cleaned_data.get('title')
+                tournament.save()
+                Match.objects.filter(match_id__in=form.cleaned_data.get('add_matches'), tournament__isnull=True).update(tournament=tournament)
+                Match.objects.filter(match_id__in=form.cleaned_data.get('remove_matches'), tournament=tournament).update(tournament=None, standings_recorded=False)
+                rebuild_standings(tournament)
             return redirect('Nations:tournament', pk=pk)
     else:
         form = ManageTournamentForm(instance=tournament)
@@ -409,57 +440,128 @@ def manage_tournament(request, pk):
         'authorized': authorized
     })
 
-def tournament_csv(request, pk):
+def seat_players(players, player_count, seating, tournament):
+    players = list(players)
+    if seating == 'random':
+        random.shuffle(players)
+    elif seating == 'standings':
+        ranks = {standing.player_id: rank for (rank, standing) in enumerate(ordered_standings(tournament))}
+        players.sort(key=lambda player: ranks.get(player.pk, len(ranks)))
+    if seating == 'seeded':
+        match_count = len(players) // player_count
+        tables = [[] for i in range(match_count)]
+        for (seed, player) in enumerate(players):
+            (tier, table) = divmod(seed, match_count)
+            if tier % 2:
+                table = match_count - 1 - table
+            tables[table].append(player)
+        return tables
+    return [players[i:i + player_count] for i in range(0, len(players), player_count)]
+
+@login_required
+def create_tournament_round(request, pk):
     tournament = get_object_or_404(Tournament, pk=pk)
-    response = HttpResponse(content_type='text/csv', headers={'Content-Disposition': f'attachment; filename=Tournament_{pk}_status.csv'})
-    csv_writer = csv.writer(response)
-    csv_writer.writerow((
-        'Match ID',
-        'Title',
-        'Created',
-        'Changed',
-        'Player Count',
-        'Growth Resources',
-        'Extra Draft',
-        'Resource Tiebreaker',
-        'Card Draw',
-        'Korea Nerf',
-        'Lincoln Nerf',
-        'Game Over',
-        'Current Player Order',
-        'Round',
-        'P1 Name',
-        'P1 Growth Resources',
-        'P1 Nation',
-        'P1 Score',
-        'P1 Remainder',
-        'P2 Name',
-        'P2 Growth Resources',
-        'P2 Nation',
-        'P2 Score',
-        'P2 Remainder',
-        'P3 Name',
-        'P3 Growth Resources',
-        'P3 Nation',
-        'P3 Score',
-        'P3 Remainder',
-        'P4 Name',
-        'P4 Growth Resources',
-        'P4 Nation',
-        'P4 Score',
-        'P4 Remainder',
-        'P5 Name',
-        'P5 Growth Resources',
-        'P5 Nation',
-        'P5 Score',
-        'P5 Remainder',
-        'P6 Name',
-        'P6 Growth Resources',
-        'P6 Nation',
-        'P6 Score',
-        'P6 Remainder'
-    ))
-    for match in tournament.matches.order_by('match_id'):
+    authorized = request.user == tournament.organizer or request.user.is_superuser
+    if request.method == 'POST' and authorized:
+        form = CreateTournamentRoundForm(request.POST)
+        if form.is_valid():
+            data = form.cleaned_data
+            tables = seat_players(data['players'], data['player_count'], data['seating'], tournament)
+            title = data['title'].strip()
+            accepted = not data['invite_players'] and data['growth_resources'] > 0
+            no_one = get_deleted_user()
+            with transaction.atomic():
+                matches = Match.objects.bulk_create([
+                    Match(
+                        title=f'{title} Match {table_number}' if title else f'Match {table_number}',
+                        player_count=data['player_count'],
+                        growth_resources=data['growth_resources'],
+                        extra_draft_nations=data['extra_draft_nations'],
+                        resource_remainder_tiebreaker=data['resource_remainder_tiebreaker'],
+                        weighted_card_draw=data['weighted_card_draw'],
+                        korea_nerf=data['korea_nerf'],
+                        lincoln_nerf=data['lincoln_nerf'],
+                        current_player=no_one,
+                        tournament=tournament
+                    )
+                    for table_number in range(1, len(tables) + 1)
+                ])
+                MatchPlayer.objects.bulk_create([
+                    MatchPlayer(match=match, player=player, growth_resources=data['growth_resources'], accepted=accepted)
+                    for (match, table) in zip(matches, tables)
+                    for player in table
+                ])
+                publish_match_cards([match.match_id for match in matches], 'created')
+            return redirect('Nations:tournament', pk=pk)
+    else:
+        form = CreateTournamentRoundForm()
+    return render(request, 'Nations/tournament_round_create.html', {
+        'IN_PRODUCTION': settings.IN_PRODUCTION,
+        'turns': number_of_turns(request.user),
+        'form': form,
+        'tournament': tournament,
+        'authorized': authorized
+    })
+
+csv_header = (
+    'Match ID',
+    'Title',
+    'Created',
+    'Changed',
+    'Player Count',
+    'Growth Resources',
+    'Extra Draft',
+    'Resource Tiebreaker',
+    'Card Draw',
+    'Korea Nerf',
+    'Lincoln Nerf',
+    'Game Over',
+    'Current Player Order',
+    'Round',
+    'P1 Name',
+    'P1 Growth Resources',
+    'P1 Nation',
+    'P1 Score',
+    'P1 Remainder',
+    'P2 Name',
+    'P2 Growth Resources',
+    'P2 Nation',
+    'P2 Score',
+    'P2 Remainder',
+    'P3 Name',
+    'P3 Growth Resources',
+    'P3 Nation',
+    'P3 Score',
+    'P3 Remainder',
+    'P4 Name',
+    'P4 Growth Resources',
+    'P4 Nation',
+    'P4 Score',
+    'P4 Remainder',
+    'P5 Name',
+    'P5 Growth Resources',
+    'P5 Nation',
+    'P5 Score',
+    'P5 Remainder',
+    'P6 Name',
+    'P6 Growth Resources',
+    'P6 Nation',
+    'P6 Score',
+    'P6 Remainder'
+)
+
+class EchoBuffer:
+    def write(self, value):
+        return value
+
+def csv_matches(matches):
+    players = MatchPlayer.objects.select_related('player').order_by('pk')
+    return matches.defer('replay').prefetch_related(Prefetch('players', queryset=players)).order_by('match_id')
+
+def csv_rows(matches):
+    csv_writer = csv.writer(EchoBuffer())
+    yield csv_writer.writerow(csv_header)
+    for match in matches.iterator(chunk_size=500):
         row = [
             str(match.match_id),
             str(match.title),
@@ -476,7 +578,7 @@ def tournament_csv(request, pk):
             str(match.current_player_order),
             str(match.current_round)
         ]
-        for player in match.players.order_by('pk'):
+        for player in match.players.all():
             row += [
                 str(player.player.username),
                 str(player.growth_resources if match.growth_resources < 0 else match.growth_resources),
@@ -484,8 +586,19 @@ def tournament_csv(request, pk):
                 str(player.score),
                 str(player.resource_remainder)
             ]
-        csv_writer.writerow(row)
-    return response
+        yield csv_writer.writerow(row)
+
+def streaming_csv_response(matches, filename):
+    return StreamingHttpResponse(csv_rows(csv_matches(matches)), content_type='text/csv', headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def tournament_csv(request, pk):
+    tournament = get_object_or_404(Tournament, pk=pk)
+    return streaming_csv_response(tournament.matches.all(), f'Tournament_{pk}_status.csv')
+
+@login_required
+@is_superuser
+def matches_csv(request):
+    return streaming_csv_response(Match.objects.all(), 'all_matches_status.csv')
 
 def stats(request):
     return render(request, 'Nations/stats.html', {
@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from Games.metrics import Counter, Gauge
+from .models import MatchPlayer
+
+import atexit
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+write_behind_pending = Gauge('tabony_write_behind_pending', 'Buffered chat read markers waiting to be flushed.')
+write_behind_writes = Counter('tabony_write_behind_writes_total', 'Chat read markers through the write-behind buffer, per outcome.')
+
+class WriteBehindBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flusher = None
+
+    def set_last_chat(self, match_player_id, last_chat):
+        with self.lock:
+            if match_player_id in self.pending:
+                write_behind_writes.inc(outcome='coalesced')
+            else:
+                write_behind_writes.inc(outcome='buffered')
+            self.pending[match_player_id] = max(last_chat, self.pending.get(match_player_id, last_chat))
+            write_behind_pending.set(len(self.pending))
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_periodically, name='nations-write-behind', daemon=True)
+                self.flusher.start()
+
+    def last_chat(self, match_player):
+        with self.lock:
+            return max(match_player.last_chat, self.pending.get(match_player.pk, 0))
+
+    def take(self, match_player_ids):
+        with self.lock:
+            if match_player_ids is None:
+                (taken, self.pending) = (self.pending, {})
+            else:
+                taken = {match_player_id: self.pending.pop(match_player_id) for match_player_id in match_player_ids if match_player_id in self.pending}
+            write_behind_pending.set(len(self.pending))
+        return taken
+
+    def restore(self, taken):
+        with self.lock:
+            for (match_player_id, last_chat) in taken.items():
+                self.pending[match_player_id] = max(last_chat, self.pending.get(match_player_id, last_chat))
+            write_behind_pending.set(len(self.pending))
+
+    def flush(self, match_player_ids=None):
+        taken = self.take(match_player_ids)
+        if not taken:
+            return
+        try:
+            MatchPlayer.objects.bulk_update([MatchPlayer(pk=match_player_id, last_chat=Greatest(F('last_chat'), Value(last_chat))) for (match_player_id, last_chat) in taken.items()], ['last_chat'], batch_size=settings.WRITE_BEHIND_BATCH_SIZE)
+        except Exception:
+            logger.exception('Could not flush %d buffered chat read markers', len(taken))
+            write_behind_writes.inc(len(taken), outcome='retried')
+            self.restore(taken)
+            return
+        write_behind_writes.inc(len(taken), outcome='flushed')
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(settings.WRITE_BEHIND_INTERVAL)
+            self.flush()
+            connection.close_if_unusable_or_obsolete()
+
+write_behind = WriteBehindBuffer()
+atexit.register(write_behind.flush)